@@ -1,6 +1,7 @@
 import asyncio
 import random
-from mqtt_bus import MqttBus
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from mqtt_bus import MqttBus, current_room, current_trace
 
 _JOKES = [
     "¿Qué le dice un techo a otro? Techo de menos.",
@@ -8,6 +9,16 @@ _JOKES = [
     "¿Por qué la computadora fue al médico? Porque tenía un virus."
 ]
 
+# intent → (método de Actions, nombres de slots que recibe como argumentos)
+_HANDLERS: Dict[str, Tuple[Callable[..., Awaitable[None]], Tuple[str, ...]]] = {}
+
+def intent_handler(intent: str, *slots: str):
+    """Registra un método de Actions como manejador de `intent` (tabla de despacho O(1))."""
+    def decorator(fn):
+        _HANDLERS[intent] = (fn, slots)
+        return fn
+    return decorator
+
 class Actions:
     """
     Acciones asociadas a intents. Publican eventos MQTT u otras tareas locales.
@@ -16,32 +27,39 @@ class Actions:
         self.bus = bus
 
     # ----- SPOTIFY -----
+    @intent_handler("play_spotify")
     async def play_spotify(self):
         # Reproducción por defecto (playlist/query que definas en el agent)
         await self.bus.publish("spotify/play", "true")
 
+    @intent_handler("play_song_by_name", "query")
     async def play_song_by_name(self, query: str):
         # Reproducir una canción por nombre (el agent la busca y la pone)
         await self.bus.publish("spotify/play_song", query or "")
 
+    @intent_handler("next_track")
     async def next_track(self):
         # Pasar a la siguiente canción
         await self.bus.publish("spotify/next", "1")
 
     # ----- OTROS -----
+    @intent_handler("tell_joke")
     async def tell_joke(self):
         joke = random.choice(_JOKES)
         await self.bus.publish("tts/say", joke)
         await self.bus.publish("log/info", f"JOKE::{joke}")
 
-    async def handle(self, intent: str, slots: dict):
-        if intent == "play_spotify":
-            await self.play_spotify()
-        elif intent == "play_song_by_name":
-            await self.play_song_by_name(slots.get("query", ""))
-        elif intent == "next_track":
-            await self.next_track()
-        elif intent == "tell_joke":
-            await self.tell_joke()
-        else:
-            await self.bus.publish("log/warn", f"Intent no soportado: {intent}")
+    async def handle(self, intent: str, slots: dict, room: Optional[str] = None, trace: Optional[str] = None):
+        # Habitación y traza viajan en el contexto hasta MqttBus.publish (user properties "room"/"trace")
+        token = current_room.set(room)
+        trace_token = current_trace.set(trace)
+        try:
+            entry = _HANDLERS.get(intent)
+            if entry is None:
+                await self.bus.publish("log/warn", f"Intent no soportado: {intent}")
+                return
+            fn, slot_names = entry
+            await fn(self, *(slots.get(name, "") for name in slot_names))
+        finally:
+            current_trace.reset(trace_token)
+            current_room.reset(token)
@@ -0,0 +1,376 @@
+"""
+Utilidades de audio para el pipeline de STT (NumPy, sin dependencias extra).
+"""
+import threading
+import time
+from collections import deque
+from math import gcd
+from multiprocessing import shared_memory
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+class PolyphaseResampler:
+    """
+    Remuestreo racional (up/down) por bloques con filtro FIR polifásico.
+    Mantiene estado entre bloques, así que se puede alimentar con los
+    bloques del micro tal cual llegan. Entrada y salida: PCM int16 mono.
+    """
+    def __init__(self, rate_in: int, rate_out: int, zero_crossings: int = 8, rolloff: float = 0.9):
+        g = gcd(rate_in, rate_out)
+        self.rate_in = rate_in
+        self.rate_out = rate_out
+        self.up = rate_out // g
+        self.down = rate_in // g
+        self.passthrough = self.up == self.down
+        if self.passthrough:
+            return
+
+        # Filtro paso bajo (sinc con ventana de Kaiser) a la frecuencia de Nyquist menor
+        n_taps = 2 * zero_crossings * max(self.up, self.down)
+        n_taps += (-n_taps) % self.up  # múltiplo de 'up' para repartir en fases
+        cutoff = rolloff * 0.5 / max(self.up, self.down)
+        n = np.arange(n_taps) - (n_taps - 1) / 2
+        h = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(n_taps, 8.0) * self.up
+        # phases[p, k] = h[p + k*up]
+        self._phases = h.reshape(-1, self.up).T.astype(np.float32)
+        self._k = self._phases.shape[1]
+        self._taps = np.arange(self._k)
+        self._hist = np.zeros(self._k - 1, dtype=np.float32)
+        # Posición de la siguiente salida, en muestras sobremuestreadas, relativa al buffer
+        self._pos = (self._k - 1) * self.up
+
+    def process(self, data) -> bytes:
+        if self.passthrough:
+            return bytes(data)
+        x = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+        buf = np.concatenate((self._hist, x))
+        end = len(buf) * self.up
+        count = max(0, -(-(end - self._pos) // self.down))
+        pos = self._pos + np.arange(count) * self.down
+        idx = (pos // self.up)[:, None] - self._taps[None, :]
+        y = np.einsum("ij,ij->i", buf[idx], self._phases[pos % self.up])
+
+        self._pos += count * self.down - (len(buf) - (self._k - 1)) * self.up
+        self._hist = buf[len(buf) - (self._k - 1):]
+        return np.clip(np.rint(y), -32768, 32767).astype(np.int16).tobytes()
+
+    def reset(self):
+        if not self.passthrough:
+            self._hist[:] = 0
+            self._pos = (self._k - 1) * self.up
+
+
+class VoiceGate:
+    """
+    Puerta de actividad de voz delante de Vosk: en silencio no se decodifica nada.
+    - Detección por energía (RMS con suelo de ruido adaptativo) + tasa de cruces por cero,
+      o WebRTC VAD si mode="webrtc" y está instalado `webrtcvad`.
+    - Hangover: mantiene la puerta abierta un rato tras la última voz.
+    - Pre-roll: guarda los últimos bloques de silencio para no cortar el inicio de la frase.
+    """
+    def __init__(self, rate: int, block_ms: int, mode: str = "energy",
+                 threshold_db: float = -45.0, noise_margin_db: float = 10.0, max_zcr: float = 0.35,
+                 hangover_ms: int = 800, preroll_ms: int = 300, webrtc_aggressiveness: int = 2):
+        self.rate = rate
+        self.mode = mode
+        self.threshold_db = threshold_db
+        self.noise_margin_db = noise_margin_db
+        self.max_zcr = max_zcr
+        self.hangover_blocks = max(1, -(-hangover_ms // block_ms))
+        self.preroll = deque(maxlen=max(0, -(-preroll_ms // block_ms)))
+
+        self._vad = None
+        if mode == "webrtc":
+            import webrtcvad  # opcional: pip install webrtcvad
+            self._vad = webrtcvad.Vad(webrtc_aggressiveness)
+            self._frame_bytes = int(rate * 0.03) * 2  # WebRTC acepta tramas de 10/20/30 ms
+
+        self.noise_db = threshold_db - noise_margin_db
+        self.is_open = False
+        self._silent_blocks = 0
+
+    def _is_speech(self, block: bytes) -> bool:
+        if self._vad is not None:
+            fb = self._frame_bytes
+            return any(self._vad.is_speech(block[i:i + fb], self.rate)
+                       for i in range(0, len(block) - fb + 1, fb))
+
+        x = np.frombuffer(block, dtype=np.int16).astype(np.float32)
+        if len(x) == 0:
+            return False
+        rms = float(np.sqrt(np.mean(x * x)))
+        level_db = 20 * np.log10(max(rms, 1.0) / 32768.0)
+        zcr = np.count_nonzero(np.diff(np.signbit(x))) / len(x)
+        speech = (level_db > max(self.threshold_db, self.noise_db + self.noise_margin_db)
+                  and zcr < self.max_zcr)
+        # Suelo de ruido: baja rápido y sube despacio (~segundos), así sigue a un
+        # ventilador o una nevera sin que la voz lo arrastre
+        rate = 0.5 if level_db < self.noise_db else 0.01
+        self.noise_db += rate * (level_db - self.noise_db)
+        return speech
+
+    def process(self, block: bytes) -> Tuple[List[bytes], bool]:
+        """
+        Devuelve (bloques a decodificar, fin_de_voz). fin_de_voz es True en el bloque
+        en que la puerta se cierra, para que el llamante pida el resultado final.
+        """
+        if self._is_speech(block):
+            self._silent_blocks = 0
+            if not self.is_open:
+                self.is_open = True
+                out = list(self.preroll)
+                self.preroll.clear()
+                out.append(block)
+                return out, False
+            return [block], False
+
+        if self.is_open:
+            self._silent_blocks += 1
+            if self._silent_blocks >= self.hangover_blocks:
+                self.is_open = False
+                return [block], True
+            return [block], False
+
+        self.preroll.append(block)
+        return [], False
+
+    def reset(self):
+        self.preroll.clear()
+        self.is_open = False
+        self._silent_blocks = 0
+
+
+class AudioRingBuffer:
+    """
+    Buffer circular de bytes preasignado entre el callback de audio y el hilo de Vosk.
+    Sustituye a una queue.Queue sin límite: la memoria no crece y la latencia queda acotada.
+
+    Política al llenarse:
+    - "drop_oldest": descarta el audio más antiguo (latencia mínima; por defecto).
+    - "drop_newest": descarta el bloque que llega.
+    - "block": el productor espera hueco (hasta block_timeout).
+
+    Contadores: overruns (veces que se perdió audio), dropped_bytes, depth y max_depth (bytes).
+    """
+    POLICIES = ("drop_oldest", "drop_newest", "block")
+
+    def __init__(self, capacity: int, policy: str = "drop_oldest", block_timeout: float = 0.1):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Política de buffer desconocida: {policy} (usa {', '.join(self.POLICIES)})")
+        capacity -= capacity % 2  # muestras int16 completas
+        self.capacity = capacity
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self._buf = np.zeros(capacity, dtype=np.uint8)
+        self._out = np.zeros(0, dtype=np.uint8)
+        self._read = 0
+        self._size = 0
+        self._cond = threading.Condition()
+
+        self.overruns = 0
+        self.dropped_bytes = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self) -> int:
+        return self._size
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def put(self, data) -> bool:
+        """Copia `data` (bytes, memoryview o array) al buffer. Devuelve False si se descartó."""
+        src = np.frombuffer(data, dtype=np.uint8)
+        n = len(src)
+        if n > self.capacity:
+            src = src[n - self.capacity:]
+            self.overruns += 1
+            self.dropped_bytes += n - self.capacity
+            n = self.capacity
+        with self._cond:
+            free = self.capacity - self._size
+            if n > free:
+                if self.policy == "block":
+                    self._cond.wait_for(lambda: self.capacity - self._size >= n, self.block_timeout)
+                    free = self.capacity - self._size
+                if n > free and self.policy == "drop_oldest":
+                    lost = n - free
+                    self._read = (self._read + lost) % self.capacity
+                    self._size -= lost
+                    self.overruns += 1
+                    self.dropped_bytes += lost
+                elif n > free:
+                    self.overruns += 1
+                    self.dropped_bytes += n
+                    return False
+
+            start = (self._read + self._size) % self.capacity
+            first = min(n, self.capacity - start)
+            self._buf[start:start + first] = src[:first]
+            self._buf[:n - first] = src[first:]
+            self._size += n
+            self.max_depth = max(self.max_depth, self._size)
+            self._cond.notify_all()
+        return True
+
+    def get(self, max_bytes: int, timeout: Optional[float] = None) -> Optional[memoryview]:
+        """
+        Espera datos y devuelve hasta max_bytes. El resultado es una vista sobre un
+        buffer interno reutilizado: válida hasta la siguiente llamada a get().
+        Devuelve None si vence el timeout.
+        """
+        max_bytes -= max_bytes % 2
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._size > 0, timeout):
+                return None
+            n = min(self._size, max_bytes)
+            n -= n % 2
+            if len(self._out) < n:
+                self._out = np.zeros(max_bytes, dtype=np.uint8)
+            first = min(n, self.capacity - self._read)
+            self._out[:first] = self._buf[self._read:self._read + first]
+            self._out[first:n] = self._buf[:n - first]
+            self._read = (self._read + n) % self.capacity
+            self._size -= n
+            self._cond.notify_all()
+            return memoryview(self._out)[:n]
+
+    def clear(self):
+        with self._cond:
+            self._read = 0
+            self._size = 0
+            self._cond.notify_all()
+
+
+class SharedAudioRing:
+    """
+    Buffer circular en memoria compartida entre procesos: el callback de audio escribe
+    en un proceso y el reconocedor lee en otro (ver stt_process.py). Misma interfaz
+    que AudioRingBuffer para el lector (get, depth, contadores).
+
+    Un solo productor y un solo consumidor, sin locks: el productor solo avanza el
+    índice de escritura y el consumidor el de lectura (contadores de bytes totales,
+    enteros de 64 bits alineados). Así, si el proceso lector muere a mitad de una
+    lectura, el callback de audio nunca se queda bloqueado. Al llenarse se descarta
+    lo más antiguo (el lector salta hacia delante); las demás políticas de
+    AudioRingBuffer necesitarían que el productor esperase al lector.
+    """
+    _W, _R, _OVERRUNS, _DROPPED, _MAX_DEPTH = range(5)
+    _HEADER = 8 * 8  # int64[8]
+
+    def __init__(self, capacity: int, name: Optional[str] = None, poll_s: float = 0.005):
+        capacity -= capacity % 2
+        self.capacity = capacity
+        self.poll_s = poll_s
+        self._owner = name is None
+        if self._owner:
+            self._shm = shared_memory.SharedMemory(create=True, size=self._HEADER + capacity)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self._map()
+
+    def _map(self):
+        self._hdr = np.ndarray(8, dtype=np.int64, buffer=self._shm.buf)
+        self._buf = np.ndarray(self.capacity, dtype=np.uint8, buffer=self._shm.buf, offset=self._HEADER)
+        self._out = np.zeros(0, dtype=np.uint8)
+        if self._owner:
+            self._hdr[:] = 0
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    # Se pasa al proceso hijo por nombre: allí se vuelve a abrir el mismo segmento
+    def __getstate__(self):
+        return {"capacity": self.capacity, "name": self._shm.name, "poll_s": self.poll_s}
+
+    def __setstate__(self, state):
+        self.capacity = state["capacity"]
+        self.poll_s = state["poll_s"]
+        self._owner = False
+        self._shm = shared_memory.SharedMemory(name=state["name"])
+        self._map()
+
+    @property
+    def depth(self) -> int:
+        return int(min(self._hdr[self._W] - self._hdr[self._R], self.capacity))
+
+    @property
+    def overruns(self) -> int:
+        return int(self._hdr[self._OVERRUNS])
+
+    @property
+    def dropped_bytes(self) -> int:
+        return int(self._hdr[self._DROPPED])
+
+    @property
+    def max_depth(self) -> int:
+        return int(self._hdr[self._MAX_DEPTH])
+
+    def empty(self) -> bool:
+        return self.depth == 0
+
+    def put(self, data) -> bool:
+        """Productor (callback de audio). Nunca espera: si no cabe, pisa lo más antiguo."""
+        src = np.frombuffer(data, dtype=np.uint8)
+        if len(src) > self.capacity:
+            src = src[len(src) - self.capacity:]
+        n = len(src)
+        w = int(self._hdr[self._W])
+        start = w % self.capacity
+        first = min(n, self.capacity - start)
+        self._buf[start:start + first] = src[:first]
+        self._buf[:n - first] = src[first:]
+        self._hdr[self._W] = w + n  # publica los datos ya copiados
+        depth = w + n - int(self._hdr[self._R])
+        if depth > self.capacity:
+            self._hdr[self._OVERRUNS] += 1
+            self._hdr[self._DROPPED] += min(depth - self.capacity, n)
+        if depth > self._hdr[self._MAX_DEPTH]:
+            self._hdr[self._MAX_DEPTH] = min(depth, self.capacity)
+        return True
+
+    def get(self, max_bytes: int, timeout: Optional[float] = None) -> Optional[memoryview]:
+        """
+        Consumidor. Devuelve hasta max_bytes (vista sobre un buffer reutilizado, válida
+        hasta la siguiente llamada) o None si vence el timeout o el productor pisó lo que
+        se estaba leyendo. Espera sondeando cada poll_s.
+        """
+        max_bytes -= max_bytes % 2
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            w = int(self._hdr[self._W])
+            r = int(self._hdr[self._R])
+            if w > r:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_s)
+        if w - r > self.capacity:
+            r = w - self.capacity  # el productor dio la vuelta: saltamos a lo más antiguo que queda
+        n = min(w - r, max_bytes)
+        n -= n % 2
+        if len(self._out) < n:
+            self._out = np.zeros(max_bytes, dtype=np.uint8)
+        start = r % self.capacity
+        first = min(n, self.capacity - start)
+        self._out[:first] = self._buf[start:start + first]
+        self._out[first:n] = self._buf[:n - first]
+        if int(self._hdr[self._W]) - r > self.capacity:
+            # Pisado mientras copiábamos: descartamos y seguimos por lo más reciente
+            self._hdr[self._R] = int(self._hdr[self._W]) - self.capacity
+            return None
+        self._hdr[self._R] = r + n
+        return memoryview(self._out)[:n]
+
+    def clear(self):
+        self._hdr[self._R] = self._hdr[self._W]
+
+    def close(self):
+        """Suelta la memoria compartida; el proceso que la creó además la elimina."""
+        self._hdr = self._buf = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
@@ -0,0 +1,68 @@
+"""
+Micro-benchmark del matcher de intents: escaneo lineal de regex (como antes)
+frente a IntentRegistry (pre-filtro por palabras clave), según el nº de intents.
+
+Uso:
+    python bench_intents.py
+    python bench_intents.py --sizes 4 100 500 1000 --queries 2000
+"""
+import argparse
+import random
+import time
+
+from intents import IntentRegistry, _REGISTRY
+
+_QUERIES = [
+    "pon spotify", "pon rosalía", "siguiente", "pasa canción",
+    "cuéntame un chiste", "qué hora es", "apaga la luz del salón",
+]
+
+
+def build_registry(n: int) -> IntentRegistry:
+    """Intents reales + sintéticos hasta llegar a n."""
+    reg = IntentRegistry()
+    for name, rx, keywords in _REGISTRY.entries():
+        reg.register(name, rx.pattern, keywords=keywords)
+    for i in range(len(reg), n):
+        reg.register(f"synthetic_{i}", rf"\b(accion{i}|orden{i})\b.*\b(objeto{i})\b",
+                     keywords=(f"accion{i}", f"orden{i}"))
+    return reg
+
+
+def match_linear(reg: IntentRegistry, text: str):
+    t = text.strip()
+    for name, rx, _ in reg.entries():
+        m = rx.search(t)
+        if m:
+            return name, {k: v.strip() for k, v in m.groupdict().items() if v is not None}
+    return None
+
+
+def bench(fn, queries) -> float:
+    t0 = time.perf_counter()
+    for q in queries:
+        fn(q)
+    return len(queries) / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de matching de intents")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[4, 50, 200, 1000])
+    parser.add_argument("--queries", type=int, default=5000)
+    args = parser.parse_args()
+
+    print(f"{'intents':>8}{'lineal/s':>14}{'registro/s':>14}{'x':>8}")
+    rng = random.Random(0)
+    for n in args.sizes:
+        reg = build_registry(n)
+        pool = _QUERIES + [f"accion{i} el objeto{i}" for i in range(len(_REGISTRY), n)]
+        queries = [rng.choice(pool) for _ in range(args.queries)]
+        for q in set(queries):
+            assert reg.match(q) == match_linear(reg, q), q
+        linear = bench(lambda q: match_linear(reg, q), queries)
+        registry = bench(reg.match, queries)
+        print(f"{n:>8}{linear:>14,.0f}{registry:>14,.0f}{registry / linear:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,20 @@
 from pathlib import Path
 
 # === AUDIO ===
-SAMPLE_RATE = 48000  # Vosk recomienda 8k o 16k; 16k suele ir mejor
+SAMPLE_RATE = 16000  # frecuencia a la que decodifica Vosk; recomienda 8k o 16k, 16k suele ir mejor
+CAPTURE_SAMPLE_RATE = None  # frecuencia del micro; None = la nativa del dispositivo (se remuestrea a SAMPLE_RATE)
 AUDIO_BLOCK_MS = 60  # tamaño del bloque de captura (ms)
+AUDIO_BUFFER_MS = 2000  # capacidad del buffer circular micro → Vosk (ms de audio)
+AUDIO_OVERFLOW_POLICY = "drop_oldest"  # "drop_oldest", "drop_newest" o "block"
+
+# === VAD (puerta de voz delante de Vosk: el silencio no se decodifica) ===
+VAD_ENABLED = True
+VAD_MODE = "energy"  # "energy" (RMS + cruces por cero) o "webrtc" (requiere: pip install webrtcvad)
+VAD_THRESHOLD_DB = -45.0  # nivel mínimo (dBFS) para considerar que hay voz
+VAD_NOISE_MARGIN_DB = 10.0  # margen sobre el ruido de fondo estimado
+VAD_MAX_ZCR = 0.35  # por encima, ruido de banda ancha (siseo) y no voz
+VAD_HANGOVER_MS = 800  # silencio tras la voz antes de cerrar la puerta
+VAD_PREROLL_MS = 300  # audio previo que se entrega al abrir, para no cortar el inicio
 
 # === VOSK MODEL ===
 # Ruta a la carpeta del modelo descargado de:
@@ -10,12 +22,52 @@ AUDIO_BLOCK_MS = 60  # tamaño del bloque de captura (ms)
 # Ej: "models/vosk-model-small-es-0.42"
 VOSK_MODEL_PATH = Path("../../vosk_models/vosk-model-small-es-0.42")
 
+# === HABITACIONES ===
+# Varios micros en el mismo host comparten un único modelo cargado.
+# {"salon": None, "cocina": "USB Audio"}: nombre → dispositivo de sounddevice (índice o nombre).
+# Vacío = un solo micro (el de por defecto) y sin etiqueta de habitación.
+STT_ROOMS = {}
+
+# === PROCESO DE STT ===
+STT_PROCESS = False  # captura en este proceso, reconocimiento en otro (audio por memoria compartida)
+STT_RESTART_MIN_S = 1  # espera antes de relanzar un reconocedor caído (se duplica si vuelve a caer)
+STT_RESTART_MAX_S = 30
+STT_RESTART_RESET_S = 60  # si aguantó vivo este tiempo, la espera vuelve al mínimo
+STT_METRICS_SYNC_S = 5  # cada cuánto el reconocedor manda sus métricas al proceso principal
+
+# === STREAMING (parciales de Vosk) ===
+STT_STREAMING = True  # dispara intents cortos con resultados parciales, sin esperar al fin de frase
+PARTIAL_STABLE_BLOCKS = 2  # bloques seguidos con el mismo parcial para darlo por estable
+EARLY_INTENTS = ("next_track", "play_spotify")  # intents cortos e inequívocos que se disparan antes
+
+# === MODO COMANDO (gramática restringida generada desde intents.py) ===
+STT_COMMAND_MODE = False  # decodifica solo las frases de los intents; 'pon <canción>' desconocida cae al vocabulario abierto
+SLOT_VOCAB_SIZE = 50  # artistas recientes (de spotify/track/artists) que se añaden a la gramática
+
+# === PALABRA DE ACTIVACIÓN ===
+WAKE_WORD_ENABLED = False  # solo se decodifica una orden después de oír la palabra de activación
+WAKE_WORDS = ("daisy", "deisi", "deisy")  # grafías aceptadas (las que el modelo no conozca se ignoran)
+WAKE_WINDOW_MS = 5000  # tiempo para empezar la orden tras la palabra (una orden por activación)
+WAKE_REPLAY_MS = 400  # audio previo a la detección que se repite al reconocedor principal
+
 # === MQTT ===
 MQTT_HOST = "localhost"
 MQTT_PORT = 1883
 MQTT_USERNAME = None  # o "usuario"
 MQTT_PASSWORD = None  # o "clave"
 MQTT_BASE_TOPIC = "assistant"  # prefijo para tus topics
+MQTT_PUBLISH_QUEUE = 256  # mensajes en cola de publicación antes de frenar a quien publica
+MQTT_MAX_INFLIGHT = 32  # mensajes QoS 1/2 esperando ack a la vez
+MQTT_BATCH_SIZE = 16  # mensajes que se envían por vuelta de la tarea de publicación (1 = sin lotes)
+MQTT_RECONNECT_MIN_S = 1  # espera inicial antes de reconectar (se duplica en cada intento)
+MQTT_RECONNECT_MAX_S = 30  # espera máxima entre reintentos
+MQTT_ACK_TIMEOUT_S = 5.0  # máximo que publish() espera el ack de un QoS 1/2
+MQTT_OUTBOX_SIZE = 500  # mensajes guardados sin conexión (al llenarse se descartan los más antiguos)
+MQTT_OUTBOX_PATH = None  # p.ej. "mqtt_outbox.jsonl" para que el outbox sobreviva a un reinicio
+
+# === MÉTRICAS ===
+METRICS_PORT = None  # p.ej. 9100: endpoint Prometheus en http://<pi>:9100/metrics
+METRICS_PUBLISH_S = 30  # cada cuánto se publican en JSON en <base>/metrics (0 = nunca)
 
 # === OTROS ===
 DEBUG_LOG = True  # imprime logs de depuración
@@ -1,33 +1,121 @@
 import re
-from typing import Optional, Tuple
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+from metrics import METRICS
 
-_PATTERNS = [
-    # "Pon Spotify" / "Pon música"
-    (re.compile(r"\b(pon|reproduce|enciende)\b.*\b(spotify|m[uú]sica)\b", re.IGNORECASE),
-     ("play_spotify", {})),
+_ACCENTS = str.maketrans("áéíóúüàèìòù", "aeiouuaeiou")
 
-    # "Pon <canción>" / "Reproduce <canción>"
-    # Captura lo que viene después del verbo como 'query'
-    (re.compile(r"\b(pon|reproduce)\b\s+(.+)", re.IGNORECASE),
-     ("play_song_by_name", {"slot": "query"})),
+def _fold(text: str) -> str:
+    """Minúsculas y sin tildes, para comparar palabras clave ('próxima' == 'proxima')."""
+    return text.casefold().translate(_ACCENTS)
 
-    # "Siguiente" / "Pasa canción"
-    (re.compile(r"\b(siguiente|pasa\s+canci[oó]n|pr[oó]xima)\b", re.IGNORECASE),
-     ("next_track", {})),
+_WORD_RX = re.compile(r"\w+")
 
-    # "Cuéntame un chiste"
-    (re.compile(r"\b(cu[eé]ntame|dime|cuenta)\b.*\b(chiste)\b", re.IGNORECASE),
-     ("tell_joke", {})),
-]
+class IntentRegistry:
+    """
+    Tabla de intents con matching en una sola pasada.
+
+    Cada intent declara sus palabras clave (alguna debe aparecer en el texto para que
+    el patrón pueda casar). match() tokeniza el texto una vez, busca cada palabra en un
+    diccionario palabra → intents y solo evalúa la regex de los candidatos, en orden de
+    registro (el primero que case gana, igual que la lista lineal de antes).
+    Los slots salen de los grupos con nombre del patrón: (?P<query>...).
+    """
+    def __init__(self):
+        self._intents: List[Tuple[str, "re.Pattern[str]", Tuple[str, ...]]] = []
+        self._by_keyword: Dict[str, List[int]] = {}
+        self.phrases: Dict[str, List[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._intents)
+
+    def register(self, name: str, pattern: str, keywords: Iterable[str], phrases: Iterable[str] = ()):
+        """
+        Registra un intent. `phrases` son ejemplos completos para la gramática del modo comando.
+        """
+        idx = len(self._intents)
+        keywords = tuple(keywords)
+        self._intents.append((name, re.compile(pattern, re.IGNORECASE), keywords))
+        for kw in keywords:
+            self._by_keyword.setdefault(_fold(kw), []).append(idx)
+        self.phrases[name] = list(phrases)
+
+    def entries(self) -> List[Tuple[str, "re.Pattern[str]", Tuple[str, ...]]]:
+        """(nombre, regex compilada, palabras clave) de cada intent, en orden de prioridad."""
+        return list(self._intents)
+
+    def match(self, text: str) -> Optional[Tuple[str, dict]]:
+        t = text.strip()
+        candidates = set()
+        for word in _WORD_RX.findall(_fold(t)):
+            hits = self._by_keyword.get(word)
+            if hits:
+                candidates.update(hits)
+        for idx in sorted(candidates):
+            name, rx, _ = self._intents[idx]
+            m = rx.search(t)
+            if m:
+                slots = {k: v.strip() for k, v in m.groupdict().items() if v is not None}
+                return name, slots
+        return None
+
+_REGISTRY = IntentRegistry()
+
+# "Pon Spotify" / "Pon música"
+_REGISTRY.register(
+    "play_spotify",
+    r"\b(pon|reproduce|enciende)\b.*\b(spotify|m[uú]sica)\b",
+    keywords=("pon", "reproduce", "enciende"),
+    phrases=[f"{v} {o}" for v in ("pon", "reproduce", "enciende") for o in ("spotify", "música")],
+)
+
+# "Pon <canción>" / "Reproduce <canción>"
+# Captura lo que viene después del verbo como 'query'
+_REGISTRY.register(
+    "play_song_by_name",
+    r"\b(pon|reproduce)\b\s+(?P<query>.+)",
+    keywords=("pon", "reproduce"),
+)
+
+# "Siguiente" / "Pasa canción"
+_REGISTRY.register(
+    "next_track",
+    r"\b(siguiente|pasa\s+canci[oó]n|pr[oó]xima)\b",
+    keywords=("siguiente", "pasa", "próxima"),
+    phrases=["siguiente", "pasa canción", "próxima"],
+)
+
+# "Cuéntame un chiste"
+_REGISTRY.register(
+    "tell_joke",
+    r"\b(cu[eé]ntame|dime|cuenta)\b.*\b(chiste)\b",
+    keywords=("cuéntame", "dime", "cuenta"),
+    phrases=[f"{v} un chiste" for v in ("cuéntame", "dime", "cuenta")],
+)
+
+# Verbos que llevan slot 'query' (play_song_by_name): su objeto viene del vocabulario dinámico
+_SLOT_VERBS = ("pon", "reproduce")
+_SLOT_VERB_RX = re.compile(r"\b(pon|reproduce)\b", re.IGNORECASE)
+
+def grammar_phrases(slot_values: Iterable[str] = ()) -> List[str]:
+    """
+    Lista de frases para KaldiRecognizer en modo comando: las frases fijas de los
+    intents, '<verbo> <valor>' por cada valor de slot conocido (p.ej. artistas
+    recientes) y '[unk]' para que lo desconocido no se fuerce a una orden.
+    """
+    phrases = [p for ps in _REGISTRY.phrases.values() for p in ps]
+    for value in slot_values:
+        phrases += [f"{verb} {value.lower()}" for verb in _SLOT_VERBS]
+    phrases += list(_SLOT_VERBS)
+    phrases.append("[unk]")
+    return phrases
+
+def needs_open_vocabulary(text: str) -> bool:
+    """En modo comando, 'pon [unk]' es una canción fuera de la gramática: hay que redecodificar."""
+    return "[unk]" in text and _SLOT_VERB_RX.search(text) is not None
 
 def match_intent(text: str) -> Optional[Tuple[str, dict]]:
-    t = text.strip()
-    for rx, (intent, data) in _PATTERNS:
-        m = rx.search(t)
-        if m:
-            slots = {}
-            if data.get("slot") == "query":
-                # Toma el grupo 2 (lo que viene tras 'pon|reproduce')
-                slots["query"] = m.group(2).strip()
-            return intent, slots
-    return None
+    t0 = time.perf_counter()
+    match = _REGISTRY.match(text)
+    METRICS.observe("intent_match_seconds", time.perf_counter() - t0)
+    return match
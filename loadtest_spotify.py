@@ -0,0 +1,148 @@
+"""
+Prueba de carga de spotify_agent.py contra la API simulada (mock_spotify.py):
+arranca el mock y el agent en este proceso, dispara órdenes MQTT por el broker
+local (mosquitto, ver README) y mide cuánto tarda cada orden en llegar a Spotify
+y cuántas llamadas a la API cuesta.
+
+Latencia de una orden = publish MQTT → la llamada que la ejecuta en el mock
+(PUT play con su URI para play_song, el siguiente POST next para next). Las
+órdenes coalescidas o sustituidas por otra más reciente salen como "sin efecto".
+
+Uso:
+    python loadtest_spotify.py
+    python loadtest_spotify.py --commands 200 --rate 5 --latency-ms 120 --rate-429 0.05
+"""
+import argparse
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import paho.mqtt.client as mqtt
+
+from mock_spotify import MockSpotify, track_for
+from replay import percentile
+
+KINDS = ("next", "play_song", "play")
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """'next=0.6,play_song=0.3,play=0.1' → pesos por tipo de orden."""
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in KINDS:
+            raise argparse.ArgumentTypeError(f"orden desconocida: {kind} (válidas: {', '.join(KINDS)})")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+
+def start_agent(mock: MockSpotify, base: str, search_cache: bool):
+    # spotify_agent lee su configuración del entorno al importarse
+    os.environ["SPOTIFY_API_URL"] = mock.url
+    os.environ["MQTT_BASE_TOPIC"] = base
+    if not search_cache:
+        os.environ["SPOTIFY_SEARCH_CACHE"] = ""
+    import spotify_agent
+    agent = spotify_agent.SimpleSpotifyAgent()
+    threading.Thread(target=agent.start, daemon=True).start()
+    deadline = time.monotonic() + 10
+    while not agent.client.is_connected():
+        if time.monotonic() > deadline:
+            raise SystemExit(f"[LOAD] El agent no conecta con el broker {spotify_agent.MQTT_HOST}:{spotify_agent.MQTT_PORT}")
+        time.sleep(0.05)
+    time.sleep(0.2)  # margen para que el broker registre sus subscripciones
+    return spotify_agent, agent
+
+
+def run(args) -> Tuple[List[Tuple[float, str, str]], MockSpotify, object]:
+    mock = MockSpotify(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                       rate_429=args.rate_429, retry_after_s=args.retry_after, seed=args.seed)
+    mock.start()
+    spotify_agent, agent = start_agent(mock, args.base, args.search_cache)
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.connect(spotify_agent.MQTT_HOST, spotify_agent.MQTT_PORT, 60)
+    client.loop_start()
+
+    topics = {"next": spotify_agent.TOPIC_CMD_NEXT, "play_song": spotify_agent.TOPIC_CMD_PLAY_SONG,
+              "play": spotify_agent.TOPIC_CMD_RESUME}
+    rng = random.Random(args.seed)
+    kinds, weights = zip(*args.mix.items())
+    sent: List[Tuple[float, str, str]] = []
+    for i in range(args.commands):
+        kind = rng.choices(kinds, weights)[0]
+        # Con --songs pequeño se repiten canciones y se ve el efecto de la caché de búsquedas
+        payload = f"cancion {rng.randrange(args.songs)}" if kind == "play_song" else "1"
+        sent.append((time.monotonic(), kind, payload))
+        client.publish(topics[kind], payload, qos=0)
+        time.sleep(rng.expovariate(args.rate))
+
+    time.sleep(args.settle)
+    client.loop_stop()
+    client.disconnect()
+    agent._stop.set()
+    mock.stop()
+    return sent, mock, agent
+
+
+def latencies(sent: List[Tuple[float, str, str]], events: List[Tuple[float, str, str]]) -> Dict[str, List[float]]:
+    """Por tipo de orden: segundos desde el publish hasta la primera llamada que la ejecuta."""
+    out: Dict[str, List[float]] = {k: [] for k in KINDS}
+    for t_sent, kind, payload in sent:
+        if kind == "play_song":
+            uri = track_for(payload)["uri"]
+            hits = [t for t, action, detail in events if action == "play" and detail == uri and t >= t_sent]
+        elif kind == "next":
+            hits = [t for t, action, _ in events if action == "next" and t >= t_sent]
+        else:
+            hits = [t for t, action, detail in events if action == "play" and t >= t_sent]
+        if hits:
+            out[kind].append(hits[0] - t_sent)
+    return out
+
+
+def report(args, sent, mock: MockSpotify, agent):
+    lat = latencies(sent, mock.events)
+    print(f"\n[LOAD] {len(sent)} órdenes a {args.rate}/s, API con {args.latency_ms:.0f} ms "
+          f"(+{args.jitter_ms:.0f} jitter), 429 al {args.rate_429:.0%}")
+    print(f"{'orden':<10}{'enviadas':>9}{'efecto':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind in KINDS:
+        n = sum(1 for _, k, _ in sent if k == kind)
+        if not n:
+            continue
+        vals = lat[kind]
+        print(f"{kind:<10}{n:>9}{len(vals):>8}"
+              f"{percentile(vals, 50) * 1000:>10.1f}"
+              f"{percentile(vals, 95) * 1000:>10.1f}"
+              f"{percentile(vals, 99) * 1000:>10.1f}"
+              f"{(max(vals) if vals else float('nan')) * 1000:>10.1f}")
+    total = sum(mock.calls.values())
+    print(f"API     {total} llamadas ({total / max(len(sent), 1):.2f} por orden), 429 inyectados={mock.throttled}")
+    for endpoint, count in mock.calls.most_common():
+        print(f"        {endpoint:<32}{count:>6}")
+    cache = agent.search_cache
+    print(f"agent   coalescidas={agent.commands.coalesced} caché búsquedas hits={cache.hits} misses={cache.misses}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga del agent de Spotify contra una API simulada")
+    parser.add_argument("--commands", type=int, default=100, help="órdenes a enviar")
+    parser.add_argument("--rate", type=float, default=3.0, help="órdenes por segundo (llegadas de Poisson)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("next=0.5,play_song=0.4,play=0.1"))
+    parser.add_argument("--songs", type=int, default=20, help="canciones distintas en las órdenes play_song")
+    parser.add_argument("--latency-ms", type=float, default=80, help="latencia de la API simulada")
+    parser.add_argument("--jitter-ms", type=float, default=40)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fracción de peticiones con 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--settle", type=float, default=5.0, help="espera final para órdenes en curso (s)")
+    parser.add_argument("--base", default="loadtest", help="topic base (no molesta a un agent real)")
+    parser.add_argument("--search-cache", action="store_true", help="usar la caché de búsquedas en disco")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    report(args, *run(args))
+
+
+if __name__ == "__main__":
+    main()
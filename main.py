@@ -1,48 +1,123 @@
+import time
+_T_START = time.perf_counter() # Para el desglose de arranque (incluye los imports).
+
 import asyncio
-from config import DEBUG_LOG
+import uuid
+from config import DEBUG_LOG, EARLY_INTENTS, STT_COMMAND_MODE, STT_PROCESS, METRICS_PORT, METRICS_PUBLISH_S
+from metrics import METRICS, serve_http
 from mqtt_bus import MqttBus
-from stt import VoskSTT
+from stt import SttEngine, load_model
 from intents import match_intent
 from actions import Actions
 from asyncio import run_coroutine_threadsafe 
 
+async def _timed(aw, timings: dict, key: str):
+    t0 = time.perf_counter()
+    try:
+        return await aw
+    finally:
+        timings[key] = time.perf_counter() - t0
+
+def _new_trace() -> str:
+    """Id corto por frase, para seguirla en logs y user properties MQTT hasta los agentes."""
+    return uuid.uuid4().hex[:12]
+
 class VoiceAssistant:
     def __init__(self):
         self.bus = MqttBus() # Crea y guarda el cliente MQTT en la instancia (self.bus) para poder usarlo en todo el objeto.
         self.actions = Actions(self.bus) # Crea el manejador de acciones y le inyecta el bus MQTT (dependencia) para que pueda publicar.
         self.loop = None
+        self._early_intent = {} # Por habitación: intent ya disparado con parciales en la frase actual (para no repetirlo con el final).
 
     async def start(self):
-        await self.bus.connect() # Conecta al broker MQTT.
+        timings = {"imports": time.perf_counter() - _T_START}
         self.loop = asyncio.get_running_loop()
-        # Arrancamos STT (hilo + stream de audio)
-        self.stt = VoskSTT(on_text=self.on_text_detected) # Crea el motor de STT y le pasa como callback self.on_text_detected, que se llamará cuando haya texto final reconocido.
-        self.stt.start() # Inicia la captura del micrófono y el loop de reconocimiento (hilo + flujo de audio).
+        # El modelo Vosk (lo más lento) carga en un hilo mientras se conecta al broker MQTT.
+        # Con STT_PROCESS lo carga cada proceso reconocedor, no este.
+        await asyncio.gather(
+            _timed(self.bus.connect(), timings, "mqtt"), # Conecta al broker MQTT.
+            *([] if STT_PROCESS else [_timed(asyncio.to_thread(load_model), timings, "modelo")]),
+        )
+        # Arrancamos STT (un hilo + stream de audio por habitación, un solo modelo Vosk)
+        t0 = time.perf_counter()
+        self.stt = SttEngine(on_text=self.on_text_detected, on_partial=self.on_partial_detected,
+                             on_end=self.on_utterance_end) # Crea el motor de STT (recognizers ya precalentados); on_text_detected recibe el texto final, on_partial_detected los parciales estables y on_utterance_end el cierre de cada frase.
+        timings["recognizer"] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        self.stt.start() # Inicia la captura de los micrófonos y los loops de reconocimiento.
+        timings["audio"] = time.perf_counter() - t0
+        timings["total"] = time.perf_counter() - _T_START
+        if DEBUG_LOG:
+            print("[CORE] Arranque: " + " | ".join(f"{k} {v * 1000:.0f} ms" for k, v in timings.items()))
+        if STT_COMMAND_MODE:
+            # Los artistas que va sonando el agente de Spotify entran en la gramática del modo comando
+            self.bus.subscribe("spotify/track/artists", lambda topic, payload: self.stt.add_slot_values(payload.split(",")))
+        if METRICS_PORT:
+            serve_http(METRICS, METRICS_PORT)
+            if DEBUG_LOG: print(f"[CORE] Métricas Prometheus en :{METRICS_PORT}/metrics")
         if DEBUG_LOG:
             print("[CORE] Asistente de voz iniciado. Di: 'Pon Spotify' o 'Cuéntame un chiste'.")
 
         # Mantener vivo el bucle principal (Ctrl+C para salir)
         try:
+            since_metrics = 0
             while True:
                 await asyncio.sleep(1)
+                since_metrics += 1
+                if METRICS_PUBLISH_S and since_metrics >= METRICS_PUBLISH_S:
+                    since_metrics = 0
+                    await self.bus.publish("metrics", METRICS.to_json())
         except KeyboardInterrupt: # Si pulsas Ctrl+C, se captura la interrupción y (si hay debug) se imprime un mensaje de salida ordenada.
             if DEBUG_LOG: print("\n[CORE] Saliendo…")
         finally:
-            self.stt.stop() # Detiene el hilo de STT.
+            self.stt.stop() # Detiene los hilos de STT.
             await self.bus.disconnect() # Cierra la conexión MQTT.
 
-    def on_text_detected(self, text: str):
+    def on_partial_detected(self, text: str, room=None):
+        """
+        Callback desde STT con un parcial estable. Solo dispara intents cortos e
+        inequívocos (EARLY_INTENTS), y como mucho uno por frase.
+        """
+        if self._early_intent.get(room):
+            return
+        match = match_intent(text)
+        if not match or match[0] not in EARLY_INTENTS:
+            return
+
+        intent, slots = match
+        self._early_intent[room] = intent
+        trace = _new_trace()
+        METRICS.inc("intents_total", intent=intent, early="1")
+        if DEBUG_LOG: print(f"[NLP] Intent (parcial): {intent} | slots: {slots}" + (f" | room: {room}" if room else "") + f" | trace: {trace}")
+        run_coroutine_threadsafe(self.actions.handle(intent, slots, room, trace), self.loop)
+
+    def on_text_detected(self, text: str, room=None):
         """
         Callback desde STT. No es async, así que despachamos a asyncio.create_task.
+        `room` es la habitación del micro que lo oyó (None con un solo micro).
         """
+        early = self._early_intent.pop(room, None) # Cierra la frase: el siguiente parcial ya es otra orden.
         match = match_intent(text) # Intenta detectar un intent a partir del texto reconocido.
         if not match:
+            METRICS.inc("intents_unmatched_total")
             if DEBUG_LOG: print("[NLP] No se reconoció un intent.")
             return
 
         intent, slots = match # Desempaqueta el intent y los posibles “slots” (parámetros extraídos del texto).
-        if DEBUG_LOG: print(f"[NLP] Intent: {intent} | slots: {slots}")
-        run_coroutine_threadsafe(self.actions.handle(intent, slots), self.loop) # Llama al manejador de acciones para que procese el intent.
+        if intent == early:
+            if DEBUG_LOG: print(f"[NLP] Intent {intent} ya disparado con el parcial")
+            return
+        trace = _new_trace() # Id de la frase: viaja con los publish MQTT hasta el agente que la ejecuta.
+        METRICS.inc("intents_total", intent=intent)
+        if DEBUG_LOG: print(f"[NLP] Intent: {intent} | slots: {slots}" + (f" | room: {room}" if room else "") + f" | trace: {trace}")
+        run_coroutine_threadsafe(self.actions.handle(intent, slots, room, trace), self.loop) # Llama al manejador de acciones para que procese el intent.
+
+    def on_utterance_end(self, room=None):
+        """
+        Callback desde STT al cerrar cada frase, haya texto final o no: si el final sale
+        vacío, on_text_detected no se llama y el intent del parcial no debe pasar a la siguiente.
+        """
+        self._early_intent.pop(room, None)
 
 if __name__ == "__main__":
     asyncio.run(VoiceAssistant().start())
@@ -0,0 +1,233 @@
+"""
+Métricas del proceso con muy poco coste en el camino caliente: contadores, gauges
+e histogramas de buckets fijos, todo en memoria bajo un lock. Lo que ya se cuenta
+en otros objetos (profundidad de colas, reconexiones...) no se actualiza en cada
+bloque: se lee con un colector solo cuando alguien pide las métricas.
+
+Se exponen en formato de texto de Prometheus (serve_http) o como JSON (to_json)
+para publicarlas periódicamente por MQTT en <base>/metrics. Las de otros procesos
+(p.ej. el reconocedor con STT_PROCESS) llegan con state() y se suman con set_remote().
+"""
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+PREFIX = "assistant_"
+
+# Segundos: de 1 ms (matching de intents) a 5 s (Spotify con reintentos)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Proporciones, p.ej. el factor de tiempo real del decodificado (RTF)
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0)
+
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: dict) -> _Key:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _labels_text(labels: Tuple[Tuple[str, str], ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # el último es +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Cota superior del bucket donde cae el cuantil q (lo que da de sí un histograma)."""
+        if not self.count:
+            return float("nan")
+        target, seen = q * self.count, 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """Registro de métricas del proceso. Los nombres llevan PREFIX al exportarse."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[_Key, float] = {}
+        self._gauges: Dict[_Key, float] = {}
+        self._hists: Dict[_Key, Histogram] = {}
+        self._collectors: List[Callable[["Metrics"], None]] = []
+        self._remote: Dict[str, dict] = {}  # origen → último state() recibido de otro proceso
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = LATENCY_BUCKETS, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            hist = self._hists.get(key)
+            if hist is None:
+                hist = self._hists[key] = Histogram(buckets)
+            hist.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def add_collector(self, fn: Callable[["Metrics"], None]):
+        """`fn(metrics)` se llama antes de exportar, para volcar gauges de otros objetos."""
+        self._collectors.append(fn)
+
+    def state(self) -> dict:
+        """Copia serializable (pickle) de todo lo registrado, para enviarla a otro proceso."""
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "hists": {k: (h.buckets, list(h.counts), h.sum, h.count) for k, h in self._hists.items()},
+            }
+
+    def set_remote(self, source: str, state: dict):
+        """Sustituye lo último recibido de `source`; se suma a lo local al exportar."""
+        with self._lock:
+            self._remote[source] = state
+
+    def _tables(self) -> Tuple[Dict[_Key, float], Dict[_Key, float], Dict[_Key, Histogram]]:
+        """Contadores, gauges e histogramas locales más los remotos. Con el lock cogido."""
+        if not self._remote:
+            return self._counters, self._gauges, self._hists
+        counters, gauges = dict(self._counters), dict(self._gauges)
+        hists: Dict[_Key, Histogram] = {}
+        for key, h in self._hists.items():
+            hists[key] = copy = Histogram(h.buckets)
+            copy.counts, copy.sum, copy.count = list(h.counts), h.sum, h.count
+        for state in self._remote.values():
+            for key, value in state["counters"].items():
+                counters[key] = counters.get(key, 0) + value
+            gauges.update(state["gauges"])
+            for key, (buckets, counts, total, count) in state["hists"].items():
+                hist = hists.get(key)
+                if hist is None:
+                    hist = hists[key] = Histogram(buckets)
+                if hist.buckets != tuple(buckets):
+                    continue  # mismo nombre con otros buckets: no se puede sumar
+                hist.counts = [a + b for a, b in zip(hist.counts, counts)]
+                hist.sum += total
+                hist.count += count
+        return counters, gauges, hists
+
+    def _collect(self):
+        for fn in self._collectors:
+            try:
+                fn(self)
+            except Exception as e:
+                print(f"[METRICS] Error en colector: {e}")
+
+    def render(self) -> str:
+        """Formato de texto de Prometheus (versión 0.0.4)."""
+        self._collect()
+        lines: List[str] = []
+        typed = set()
+        with self._lock:
+            counters, gauges, hists = self._tables()
+            for kind, table in (("counter", counters), ("gauge", gauges)):
+                for (name, labels), value in sorted(table.items()):
+                    if name not in typed:
+                        typed.add(name)
+                        lines.append(f"# TYPE {PREFIX}{name} {kind}")
+                    lines.append(f"{PREFIX}{name}{_labels_text(labels)} {value:g}")
+            for (name, labels), hist in sorted(hists.items(), key=lambda kv: kv[0]):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {PREFIX}{name} histogram")
+                seen = 0
+                for bound, n in zip(hist.buckets + (float("inf"),), hist.counts):
+                    seen += n
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f"{PREFIX}{name}_bucket{_labels_text(labels, (('le', le),))} {seen}")
+                lines.append(f"{PREFIX}{name}_sum{_labels_text(labels)} {hist.sum:g}")
+                lines.append(f"{PREFIX}{name}_count{_labels_text(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Resumen compacto: valor de contadores/gauges y count/avg/p50/p95 de histogramas."""
+        self._collect()
+        out: dict = {}
+        with self._lock:
+            counters, gauges, hists = self._tables()
+            for table in (counters, gauges):
+                for (name, labels), value in table.items():
+                    out[name + _labels_text(labels)] = value
+            for (name, labels), hist in hists.items():
+                out[name + _labels_text(labels)] = {
+                    "count": hist.count,
+                    "avg": hist.sum / hist.count if hist.count else None,
+                    "p50": hist.quantile(0.5),
+                    "p95": hist.quantile(0.95),
+                }
+        return out
+
+    def to_json(self) -> str:
+        return json.dumps(_finite(self.snapshot()), ensure_ascii=False, separators=(",", ":"))
+
+
+def _finite(value):
+    """JSON estricto: NaN/inf (histogramas vacíos o fuera de rango) se publican como null."""
+    if isinstance(value, dict):
+        return {k: _finite(v) for k, v in value.items()}
+    if isinstance(value, float) and (value != value or value in (float("inf"), float("-inf"))):
+        return None
+    return value
+
+
+def serve_http(metrics: "Metrics", port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Sirve GET /metrics en formato Prometheus desde un hilo en segundo plano."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            data = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Registro único del proceso (asistente o agent de Spotify)
+METRICS = Metrics()
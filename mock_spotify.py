@@ -0,0 +1,219 @@
+"""
+Sustituto local de la Web API de Spotify con los endpoints que usa spotify_agent.py
+(search, devices, transfer, play, next, current_playback, recently-played), con
+latencia configurable e inyección de 429. Sirve para probar y medir el agent sin
+credenciales ni red (ver loadtest_spotify.py).
+
+El agent lo usa si SPOTIFY_API_URL apunta aquí:
+    python mock_spotify.py --port 8899 --latency-ms 80 --rate-429 0.05
+    SPOTIFY_API_URL=http://127.0.0.1:8899/v1/ python spotify_agent.py
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+DEVICE_ID = "mock-device"
+TRACK_MS = 180_000
+
+
+def track_for(query: str) -> dict:
+    """Pista determinista para una búsqueda: la misma consulta da siempre la misma URI."""
+    track_id = hashlib.sha1(query.encode("utf-8")).hexdigest()[:22]
+    return {
+        "id": track_id,
+        "uri": f"spotify:track:{track_id}",
+        "name": query.title() or "Mock",
+        "duration_ms": TRACK_MS,
+        "artists": [{"name": "Mock Artist"}],
+        "album": {"name": "Mock Album", "images": []},
+    }
+
+
+class MockSpotify:
+    """
+    Estado mínimo de una cuenta (un device, la pista actual, play/pausa) servido por
+    HTTP en un hilo. `calls` cuenta peticiones por endpoint ("GET me/player", ...) y
+    `events` guarda (instante monotónico, acción, detalle) de cada play/next/transfer
+    que cambia el estado, para medir latencias desde fuera.
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 50,
+                 jitter_ms: float = 0, rate_429: float = 0.0, retry_after_s: int = 1, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after_s = retry_after_s
+        self.calls: Counter = Counter()
+        self.throttled = 0
+        self.events: List[Tuple[float, str, str]] = []
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._active = False
+        self._track: Optional[dict] = None
+        self._playing = False
+        self._progress_ms = 0
+        self._since = time.monotonic()
+        self._skips = 0
+        self._catalog = {}  # uri → pista, de lo que se ha buscado
+
+        mock = self
+
+        class Handler(_Handler):
+            spotify = mock
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1/"
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # ---------- Estado ----------
+    def _progress(self) -> int:
+        if not self._playing:
+            return self._progress_ms
+        return min(self._progress_ms + int((time.monotonic() - self._since) * 1000), TRACK_MS)
+
+    def _set_track(self, track: dict, playing: bool = True):
+        self._track, self._playing = track, playing
+        self._progress_ms, self._since = 0, time.monotonic()
+
+    def _event(self, action: str, detail: str = ""):
+        self.events.append((time.monotonic(), action, detail))
+
+    def _device(self) -> dict:
+        return {"id": DEVICE_ID, "name": "Mock Pi", "type": "Speaker",
+                "is_active": self._active, "volume_percent": 50}
+
+    def handle(self, method: str, path: str, query: dict, body: dict) -> Tuple[int, Optional[dict], dict]:
+        """(status, json o None, cabeceras extra) para una petición ya sin el prefijo /v1/."""
+        endpoint = f"{method} {path}"
+        delay = self.latency_ms + (self._rng.uniform(0, self.jitter_ms) if self.jitter_ms else 0)
+        time.sleep(delay / 1000)
+        with self._lock:
+            self.calls[endpoint] += 1
+            if self.rate_429 and self._rng.random() < self.rate_429:
+                self.throttled += 1
+                return 429, _error(429, "API rate limit exceeded"), {"Retry-After": str(self.retry_after_s)}
+
+            device = (query.get("device_id") or [DEVICE_ID])[0]
+            if device != DEVICE_ID or DEVICE_ID not in body.get("device_ids", [DEVICE_ID]):
+                return 404, _error(404, "Device not found"), {}
+
+            if endpoint == "GET search":
+                track = track_for((query.get("q") or [""])[0])
+                self._catalog[track["uri"]] = track
+                return 200, {"tracks": {"items": [track]}}, {}
+            if endpoint == "GET me/player/devices":
+                return 200, {"devices": [self._device()]}, {}
+            if endpoint == "GET me/player/recently-played":
+                items = [{"track": self._track}] if self._track else []
+                return 200, {"items": items}, {}
+            if endpoint == "GET me/player":
+                if not self._active or self._track is None:
+                    return 204, None, {}
+                return 200, {"device": self._device(), "is_playing": self._playing,
+                             "progress_ms": self._progress(), "item": self._track}, {}
+            if endpoint == "PUT me/player":
+                self._active = True
+                self._event("transfer", DEVICE_ID)
+                return 204, None, {}
+            if endpoint == "PUT me/player/play":
+                self._active = True
+                uris = body.get("uris")
+                if uris:
+                    self._set_track(self._catalog.get(uris[0]) or dict(track_for(uris[0]), uri=uris[0]))
+                elif self._track is not None:
+                    self._progress_ms, self._since, self._playing = self._progress(), time.monotonic(), True
+                self._event("play", uris[0] if uris else "")
+                return 204, None, {}
+            if endpoint == "POST me/player/next":
+                self._skips += 1
+                self._set_track(track_for(f"mock next {self._skips}"))
+                self._event("next", self._track["uri"])
+                return 204, None, {}
+        return 404, _error(404, f"Endpoint no simulado: {endpoint}"), {}
+
+
+def _error(status: int, message: str) -> dict:
+    return {"error": {"status": status, "message": message}}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, como la API real
+    spotify: MockSpotify
+
+    def _serve(self, method: str):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError:
+            body = {}
+        path = url.path[len("/v1/"):] if url.path.startswith("/v1/") else url.path.lstrip("/")
+        status, payload, headers = self.spotify.handle(method, path, parse_qs(url.query), body)
+        data = json.dumps(payload).encode("utf-8") if payload is not None else b""
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if data:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._serve("GET")
+
+    def do_PUT(self):
+        self._serve("PUT")
+
+    def do_POST(self):
+        self._serve("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Web API de Spotify simulada para pruebas locales")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8899)
+    parser.add_argument("--latency-ms", type=float, default=50, help="latencia fija por petición")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="latencia extra aleatoria (0..jitter)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fracción de peticiones que reciben 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After de los 429 (s)")
+    args = parser.parse_args()
+
+    mock = MockSpotify(args.host, args.port, args.latency_ms, args.jitter_ms, args.rate_429, args.retry_after)
+    mock.start()
+    print(f"[MOCK] Spotify simulado en {mock.url} (Ctrl+C para salir)")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"[MOCK] llamadas={sum(mock.calls.values())} 429={mock.throttled} {dict(mock.calls)}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.stop()
+
+
+if __name__ == "__main__":
+    main()
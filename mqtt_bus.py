@@ -1,8 +1,124 @@
 import asyncio
+import inspect
+import json
 import threading
-from typing import Optional
+import time
+from collections import deque
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional, Set, Union
 import paho.mqtt.client as mqtt
-from config import MQTT_HOST, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD, MQTT_BASE_TOPIC, DEBUG_LOG
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from config import (
+    MQTT_HOST, MQTT_PORT, MQTT_USERNAME, MQTT_PASSWORD, MQTT_BASE_TOPIC, DEBUG_LOG,
+    MQTT_PUBLISH_QUEUE, MQTT_MAX_INFLIGHT, MQTT_BATCH_SIZE,
+    MQTT_RECONNECT_MIN_S, MQTT_RECONNECT_MAX_S, MQTT_ACK_TIMEOUT_S, MQTT_OUTBOX_SIZE, MQTT_OUTBOX_PATH,
+)
+from metrics import METRICS
+
+# Habitación de la orden en curso. Actions.handle la fija por tarea y publish()
+# la añade como user property MQTT v5 ("room"), sin tocar topics ni payloads.
+current_room: ContextVar[Optional[str]] = ContextVar("current_room", default=None)
+# Traza de la frase en curso (un id por frase reconocida), igual que la habitación:
+# viaja como user property "trace" para seguir una orden hasta los agentes.
+current_trace: ContextVar[Optional[str]] = ContextVar("current_trace", default=None)
+
+class _Outgoing(NamedTuple):
+    topic: str
+    payload: str
+    qos: int
+    retain: bool
+    room: Optional[str]
+    future: Optional[asyncio.Future] = None  # solo QoS 1/2: se resuelve con el ack del broker
+    trace: Optional[str] = None
+    created: float = 0.0  # perf_counter al encolar (0 = recuperado del spool de disco)
+
+class Subscription:
+    """
+    Suscripción del TopicRouter. El handler recibe (topic, payload) y puede ser
+    síncrono o async; corre en el event loop con como mucho max_concurrency a la vez.
+    """
+    def __init__(self, pattern: str, handler: Callable[[str, str], Union[None, Awaitable[None]]],
+                 qos: int = 0, max_concurrency: int = 1):
+        self.pattern = pattern
+        self.handler = handler
+        self.qos = qos
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+class _Node:
+    __slots__ = ("children", "subs")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.subs: List[Subscription] = []
+
+class TopicRouter:
+    """Trie por niveles de topic con los comodines de MQTT ('+' un nivel, '#' el resto)."""
+    def __init__(self):
+        self._root = _Node()
+        self._lock = threading.Lock()  # match() corre en el hilo de red de paho
+
+    def add(self, sub: Subscription) -> bool:
+        """Añade la suscripción. Devuelve True si es la primera con ese patrón."""
+        with self._lock:
+            node = self._root
+            for level in sub.pattern.split("/"):
+                node = node.children.setdefault(level, _Node())
+            node.subs.append(sub)
+            return len(node.subs) == 1
+
+    def remove(self, sub: Subscription) -> bool:
+        """Quita la suscripción. Devuelve True si el patrón se ha quedado sin suscriptores."""
+        levels = sub.pattern.split("/")
+        with self._lock:
+            path = [self._root]
+            for level in levels:
+                node = path[-1].children.get(level)
+                if node is None:
+                    return False
+                path.append(node)
+            if sub in path[-1].subs:
+                path[-1].subs.remove(sub)
+            empty = not path[-1].subs
+            # Poda las ramas vacías
+            for depth in range(len(levels), 0, -1):
+                if path[depth].subs or path[depth].children:
+                    break
+                del path[depth - 1].children[levels[depth - 1]]
+            return empty
+
+    def patterns(self) -> Dict[str, int]:
+        """Patrón → QoS máximo pedido, para (re)suscribirse en el broker."""
+        out: Dict[str, int] = {}
+        with self._lock:
+            stack = [(self._root, [])]
+            while stack:
+                node, levels = stack.pop()
+                if node.subs:
+                    out["/".join(levels)] = max(s.qos for s in node.subs)
+                for level, child in node.children.items():
+                    stack.append((child, levels + [level]))
+        return out
+
+    def match(self, topic: str) -> List[Subscription]:
+        levels = topic.split("/")
+        out: List[Subscription] = []
+        with self._lock:
+            stack = [(self._root, 0)]
+            while stack:
+                node, i = stack.pop()
+                multi = node.children.get("#")
+                if multi is not None:
+                    out.extend(multi.subs)
+                if i == len(levels):
+                    out.extend(node.subs)
+                    continue
+                for key in (levels[i], "+"):
+                    child = node.children.get(key)
+                    if child is not None:
+                        stack.append((child, i + 1))
+        return out
 
 class MqttBus:
     def __init__(self):
@@ -15,8 +131,49 @@ class MqttBus:
             self.client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
         self.client.on_connect = self._on_connect
         self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.client.on_message = self._on_message
+        # loop_forever reconecta solo, con espera exponencial entre estos límites
+        self.client.reconnect_delay_set(MQTT_RECONNECT_MIN_S, MQTT_RECONNECT_MAX_S)
         self._connected_evt = threading.Event()
         self._thread: Optional[threading.Thread] = None
+        self._was_connected = False
+
+        # Cola de publicación: publish() encola y vuelve; una tarea la vacía por lotes
+        self._outq: "asyncio.Queue[_Outgoing]" = asyncio.Queue(MQTT_PUBLISH_QUEUE)
+        self._inflight = asyncio.Semaphore(MQTT_MAX_INFLIGHT)  # QoS 1/2 sin ack a la vez
+        self._pending: Dict[int, asyncio.Future] = {}  # mid → future (QoS 1/2)
+        self._pending_lock = threading.Lock()
+        # on_publish que llegan mientras _send aún no ha registrado su mid (mid → reason_code).
+        # paho lo llama en el mismo hilo dentro de publish() para QoS 0 (no hay hilo propio de paho)
+        self._registering = False
+        self._completed: Dict[int, object] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._sender: Optional[asyncio.Task] = None
+
+        # Suscripciones: un solo on_message enruta a todos los handlers
+        self.router = TopicRouter()
+        self._handler_tasks: Set[asyncio.Task] = set()
+
+        # Outbox: lo que se publica sin conexión espera aquí (acotado) y sale al reconectar
+        self._outbox: Deque[_Outgoing] = deque()
+        self._outbox_path = Path(MQTT_OUTBOX_PATH) if MQTT_OUTBOX_PATH else None
+        self._load_outbox()
+
+        # Métricas
+        self.reconnects = 0
+        self.spooled = 0  # mensajes que pasaron por el outbox
+        self.flushed = 0  # mensajes del outbox enviados tras reconectar
+        self.dropped = 0  # mensajes perdidos por outbox lleno
+        METRICS.add_collector(self._collect_metrics)
+
+    def _collect_metrics(self, metrics):
+        metrics.set("mqtt_publish_queue", self._outq.qsize())
+        metrics.set("mqtt_outbox", len(self._outbox))
+        metrics.set("mqtt_reconnects", self.reconnects)
+        metrics.set("mqtt_spooled", self.spooled)
+        metrics.set("mqtt_dropped", self.dropped)
+        metrics.set("mqtt_connected", 1 if self._connected_evt.is_set() else 0)
 
     # ---------- Callbacks ----------
     def _on_connect(self, client, userdata, *args):
@@ -25,7 +182,16 @@ class MqttBus:
         code = getattr(reason_code, "value", reason_code)
         if DEBUG_LOG: print(f"[MQTT] Conectado (code={code})")
         if code == 0:
+            if self._was_connected:
+                self.reconnects += 1
+            self._was_connected = True
             self._connected_evt.set()
+            # Sesión nueva en el broker: hay que volver a pedir las suscripciones
+            for pattern, qos in self.router.patterns().items():
+                client.subscribe(pattern, qos)
+            if self._loop is not None and self._outbox:
+                # Despierta al emisor para vaciar el outbox aunque no llegue nada nuevo
+                self._loop.call_soon_threadsafe(self._wake_sender)
 
     def _on_disconnect(self, client, userdata, *args):
         # args = (disconnect_flags, reason_code, properties) o (reason_code, properties)
@@ -38,47 +204,252 @@ class MqttBus:
         if DEBUG_LOG: print(f"[MQTT] Desconectado (code={code})")
         self._connected_evt.clear()
 
+    def _on_publish(self, client, userdata, mid, *args):
+        # args = (reason_code, properties) para v2. Corre en el hilo de red de paho.
+        reason_code = args[0] if args else None
+        with self._pending_lock:
+            fut = self._pending.pop(mid, None)
+            if fut is None and self._registering:
+                self._completed[mid] = reason_code
+        if fut is not None:
+            failed = getattr(reason_code, "is_failure", False)
+            self._loop.call_soon_threadsafe(self._resolve, fut, reason_code if failed else None)
+
+    def _resolve(self, fut: asyncio.Future, error):
+        self._inflight.release()
+        if not fut.done():
+            if error is None:
+                fut.set_result(None)
+            else:
+                fut.set_exception(RuntimeError(f"Publish rechazado por el broker: {error}"))
+
+    def _on_message(self, client, userdata, msg):
+        # Hilo de red de paho: solo enrutamos; los handlers corren en el event loop
+        subs = self.router.match(msg.topic)
+        if not subs or self._loop is None:
+            return
+        payload = msg.payload.decode("utf-8", errors="replace")
+        for sub in subs:
+            self._loop.call_soon_threadsafe(self._dispatch, sub, msg.topic, payload)
+
+    def _dispatch(self, sub: Subscription, topic: str, payload: str):
+        task = self._loop.create_task(self._run_handler(sub, topic, payload))
+        self._handler_tasks.add(task)
+        task.add_done_callback(self._handler_tasks.discard)
+
+    async def _run_handler(self, sub: Subscription, topic: str, payload: str):
+        async with sub.semaphore:
+            try:
+                result = sub.handler(topic, payload)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                print(f"[MQTT] Error en handler de {sub.pattern}: {e}")
+
+    # ---------- Envío ----------
+    def _ensure_sender(self):
+        if self._sender is None or self._sender.done():
+            self._loop = asyncio.get_running_loop()
+            self._sender = self._loop.create_task(self._send_loop())
+
+    def _wake_sender(self):
+        try:
+            self._outq.put_nowait(None)
+        except asyncio.QueueFull:
+            pass  # el emisor ya tiene trabajo y vaciará el outbox en la siguiente vuelta
+
+    async def _send_loop(self):
+        """Vacía la cola de publicación: hasta MQTT_BATCH_SIZE mensajes por vuelta."""
+        while True:
+            batch = [await self._outq.get()]
+            while len(batch) < MQTT_BATCH_SIZE and not self._outq.empty():
+                batch.append(self._outq.get_nowait())
+            try:
+                msgs = [m for m in batch if m is not None]  # None = aviso de reconexión
+                if self._connected_evt.is_set():
+                    await self._flush_outbox()
+                for i, msg in enumerate(msgs):
+                    if not self._connected_evt.is_set() or not await self._send(msg):
+                        for rest in msgs[i:]:
+                            self._spool(rest)
+                        break
+            except Exception as e:
+                print(f"[MQTT] Error publicando: {e}")
+            finally:
+                for _ in batch:
+                    self._outq.task_done()
+
+    async def _send(self, msg: _Outgoing) -> bool:
+        """Publica un mensaje. Devuelve False si no hay conexión y hay que guardarlo."""
+        props = None
+        if msg.room or msg.trace:
+            props = Properties(PacketTypes.PUBLISH)
+            if msg.room:
+                props.UserProperty = ("room", msg.room)
+            if msg.trace:
+                props.UserProperty = ("trace", msg.trace)
+        if msg.future is not None:
+            await self._inflight.acquire()
+        # Sin el lock durante publish(): paho puede llamar a on_publish desde aquí mismo
+        # (QoS 0) o desde su hilo con su propio mutex cogido (QoS 1/2). Un ack que llegue
+        # antes de registrar el mid queda en _completed y se resuelve al registrarlo.
+        with self._pending_lock:
+            self._registering = True
+        try:
+            info = self.client.publish(msg.topic, payload=msg.payload, qos=msg.qos,
+                                       retain=msg.retain, properties=props)
+        except Exception as e:
+            error = e
+            with self._pending_lock:
+                self._registering = False
+                self._completed.clear()
+        else:
+            sent = info.rc in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN)
+            with self._pending_lock:
+                self._registering = False
+                early = info.mid in self._completed
+                reason_code = self._completed.pop(info.mid, None)
+                self._completed.clear()
+                if sent and msg.future is not None and not early:
+                    self._pending[info.mid] = msg.future
+            if info.rc == mqtt.MQTT_ERR_NO_CONN and msg.qos == 0:
+                return False
+            if sent:
+                # QoS 1/2 sin conexión: paho lo guarda y lo reenvía al reconectar
+                if msg.future is not None and early:
+                    failed = getattr(reason_code, "is_failure", False)
+                    self._resolve(msg.future, reason_code if failed else None)
+                if msg.created:
+                    METRICS.observe("mqtt_publish_seconds", time.perf_counter() - msg.created)
+                return True
+            error = mqtt.error_string(info.rc)
+        METRICS.inc("mqtt_publish_errors_total")
+        if msg.future is not None:
+            self._resolve(msg.future, error)
+        else:
+            print(f"[MQTT] Error publicando en {msg.topic}: {error}")
+        return True
+
+    # ---------- Outbox ----------
+    def _spool(self, msg: _Outgoing):
+        if len(self._outbox) >= MQTT_OUTBOX_SIZE:
+            old = self._outbox.popleft()
+            self.dropped += 1
+            if old.future is not None and not old.future.done():
+                old.future.set_exception(RuntimeError("Mensaje descartado: outbox MQTT lleno"))
+        self._outbox.append(msg)
+        self.spooled += 1
+        if self._outbox_path is not None:
+            with self._outbox_path.open("a", encoding="utf-8") as f:
+                f.write(json.dumps({"topic": msg.topic, "payload": msg.payload, "qos": msg.qos,
+                                    "retain": msg.retain, "room": msg.room, "trace": msg.trace},
+                                   ensure_ascii=False) + "\n")
+
+    async def _flush_outbox(self):
+        if not self._outbox:
+            return
+        if DEBUG_LOG: print(f"[MQTT] Enviando {len(self._outbox)} mensajes pendientes del outbox")
+        while self._outbox and self._connected_evt.is_set():
+            msg = self._outbox.popleft()
+            if not await self._send(msg):
+                self._outbox.appendleft(msg)
+                return
+            self.flushed += 1
+        if not self._outbox and self._outbox_path is not None and self._outbox_path.exists():
+            self._outbox_path.write_text("", encoding="utf-8")
+
+    def _load_outbox(self):
+        """Recupera lo que quedó en el spool de disco de una ejecución anterior."""
+        if self._outbox_path is None or not self._outbox_path.exists():
+            return
+        for line in self._outbox_path.read_text(encoding="utf-8").splitlines()[-MQTT_OUTBOX_SIZE:]:
+            try:
+                d = json.loads(line)
+                self._outbox.append(_Outgoing(d["topic"], d["payload"], d["qos"], d["retain"], d.get("room"),
+                                              trace=d.get("trace")))
+            except (json.JSONDecodeError, KeyError):
+                continue
+
+    @property
+    def outbox_depth(self) -> int:
+        return len(self._outbox)
+
     # ---------- API pública ----------
     async def connect(self):
-        if self._thread and self._thread.is_alive():
-            return
-        self.client.connect(MQTT_HOST, MQTT_PORT, keepalive=60)
-        self._thread = threading.Thread(target=self.client.loop_forever, daemon=True)
-        self._thread.start()
+        if not (self._thread and self._thread.is_alive()):
+            self._ensure_sender()
+            # connect_async + retry_first_connection: si el broker aún no está, paho
+            # reintenta con backoff en vez de lanzar excepción
+            self.client.connect_async(MQTT_HOST, MQTT_PORT, keepalive=60)
+            self._thread = threading.Thread(
+                target=self.client.loop_forever, kwargs={"retry_first_connection": True}, daemon=True
+            )
+            self._thread.start()
         await asyncio.to_thread(self._connected_evt.wait)
 
     async def disconnect(self):
+        if self._sender is not None:
+            # Da una oportunidad a lo encolado antes de cortar
+            try:
+                await asyncio.wait_for(self._outq.join(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+            self._sender.cancel()
+            self._sender = None
         if self._thread and self._thread.is_alive():
             self.client.disconnect()
             await asyncio.sleep(0.1)
 
-    async def publish(self, topic_suffix: str, payload: str, qos: int = 0, retain: bool = False):
-        if not self._connected_evt.is_set():
-            await self.connect()
+    async def publish(self, topic_suffix: str, payload: str, qos: int = 0, retain: bool = False,
+                      wait: bool = True) -> Optional[asyncio.Future]:
+        """
+        Encola el mensaje; si la cola está llena, espera (backpressure).
+        - QoS 0: fire-and-forget, vuelve en cuanto está encolado.
+        - QoS 1/2: con wait=True espera al ack del broker; con wait=False devuelve
+          el future para esperarlo después (varios mensajes en vuelo a la vez).
+        """
+        self._ensure_sender()
         topic = f"{MQTT_BASE_TOPIC}/{topic_suffix}"
+        room = current_room.get()
+        trace = current_trace.get()
         if DEBUG_LOG:
-            print(f"[MQTT] → {topic}: {payload}")
-        info = self.client.publish(topic, payload=payload, qos=qos, retain=retain)
-        await asyncio.to_thread(info.wait_for_publish)
-
-    async def subscribe_loop(self, topic_suffix: str, handler):
-        pattern = f"{MQTT_BASE_TOPIC}/{topic_suffix}"
-        if not self._connected_evt.is_set():
-            await self.connect()
-
-        def _on_message(client, userdata, msg):
+            print(f"[MQTT] → {topic}: {payload}" + (f" (room={room})" if room else "")
+                  + (f" [{trace}]" if trace else ""))
+        fut = self._loop.create_future() if qos > 0 else None
+        t0 = time.perf_counter()
+        await self._outq.put(_Outgoing(topic, payload, qos, retain, room, fut, trace, t0))
+        if fut is not None and wait:
             try:
-                handler(msg.payload.decode("utf-8"))
-            except Exception as e:
-                print(f"[MQTT] Error en handler: {e}")
+                # Sin broker no colgamos la acción: el mensaje sigue en el outbox y saldrá al reconectar
+                await asyncio.wait_for(asyncio.shield(fut), MQTT_ACK_TIMEOUT_S)
+                METRICS.observe("mqtt_ack_seconds", time.perf_counter() - t0)
+            except asyncio.TimeoutError:
+                print(f"[MQTT] Sin ack en {MQTT_ACK_TIMEOUT_S:.0f}s para {topic}; queda pendiente")
+        return fut
 
-        self.client.on_message = _on_message
-        self.client.subscribe(pattern)
+    def subscribe(self, topic_suffix: str, handler: Callable[[str, str], Union[None, Awaitable[None]]],
+                  qos: int = 0, max_concurrency: int = 1) -> Subscription:
+        """
+        Suscribe `handler(topic, payload)` a MQTT_BASE_TOPIC/topic_suffix (admite + y #).
+        Puede haber tantas suscripciones como se quiera, también al mismo patrón.
+        Los handlers async no bloquean el hilo de red; los síncronos deben ser rápidos.
+        """
+        self._ensure_sender()  # fija el event loop donde corren los handlers
+        sub = Subscription(f"{MQTT_BASE_TOPIC}/{topic_suffix}", handler, qos, max_concurrency)
+        if self.router.add(sub) and self._connected_evt.is_set():
+            self.client.subscribe(sub.pattern, qos)
         if DEBUG_LOG:
-            print(f"[MQTT] Subscrito a {pattern}")
+            print(f"[MQTT] Subscrito a {sub.pattern}")
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        if self.router.remove(sub) and self._connected_evt.is_set():
+            self.client.unsubscribe(sub.pattern)
 
+    async def subscribe_loop(self, topic_suffix: str, handler):
+        """Compatibilidad: suscribe handler(payload) hasta que se cancele la tarea."""
+        sub = self.subscribe(topic_suffix, lambda topic, payload: handler(payload))
         try:
-            while self._connected_evt.is_set():
-                await asyncio.sleep(1.0)
+            await asyncio.Event().wait()
         finally:
-            self.client.on_message = None
+            self.unsubscribe(sub)
@@ -0,0 +1,254 @@
+"""
+Modo replay: pasa WAVs grabados por el pipeline completo
+(VoskSTT._recognize_loop → match_intent → Actions.handle) sin micrófono ni broker,
+y mide la latencia por etapa desde el fin de la frase hasta el publish MQTT.
+
+Cada WAV debe contener UNA orden (mono, 16 bits, a cualquier frecuencia: se
+remuestrea a config.SAMPLE_RATE igual que el audio del micro).
+
+Uso:
+    python replay.py grabaciones/*.wav
+    python replay.py grabaciones/*.wav --fast --repeat 5
+"""
+import argparse
+import asyncio
+import math
+import threading
+import time
+import wave
+from asyncio import run_coroutine_threadsafe
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from config import AUDIO_BLOCK_MS, AUDIO_BUFFER_MS, MQTT_BASE_TOPIC, EARLY_INTENTS
+from audio import AudioRingBuffer
+from stt import VoskSTT
+from intents import match_intent
+from actions import Actions
+
+STAGES = ("stt", "intent", "action", "total")
+
+
+class LocalBus:
+    """
+    Sustituto en proceso de MqttBus: misma API de publicación, sin sockets.
+    Guarda (instante, topic, payload) de cada mensaje para medir latencias.
+    """
+    def __init__(self):
+        self.published: List[Tuple[float, str, str]] = []
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    async def publish(self, topic_suffix: str, payload: str, qos: int = 0, retain: bool = False):
+        topic = f"{MQTT_BASE_TOPIC}/{topic_suffix}"
+        self.published.append((time.perf_counter(), topic, payload))
+
+
+class _TimedRecognizer:
+    """Envuelve un KaldiRecognizer y acumula el tiempo pasado en AcceptWaveform."""
+    def __init__(self, rec):
+        self._rec = rec
+        self._lock = threading.Lock()
+        self.decode_s = 0.0
+
+    def AcceptWaveform(self, data):
+        with self._lock:
+            t0 = time.perf_counter()
+            r = self._rec.AcceptWaveform(data)
+            self.decode_s += time.perf_counter() - t0
+            return r
+
+    def Reset(self):
+        with self._lock:
+            self._rec.Reset()
+
+    def __getattr__(self, name):
+        return getattr(self._rec, name)
+
+
+def read_wav(path: Path) -> Tuple[bytes, int]:
+    with wave.open(str(path), "rb") as wf:
+        if wf.getnchannels() != 1 or wf.getsampwidth() != 2:
+            raise ValueError(
+                f"{path}: el WAV debe ser mono y de 16 bits "
+                f"(es {wf.getnchannels()} canales, {wf.getsampwidth() * 8} bits)"
+            )
+        return wf.readframes(wf.getnframes()), wf.getframerate()
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Percentil por rango más cercano (suficiente para un informe de latencias)."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, math.ceil(p / 100.0 * len(ordered)) - 1))
+    return ordered[k]
+
+
+class ReplayRunner:
+    """
+    Alimenta la cola de VoskSTT con bloques del mismo tamaño que el micro
+    (AUDIO_BLOCK_MS), a ritmo real o lo más rápido posible (fast=True).
+    El buffer usa la política "block": con --fast el fichero entra de golpe y con
+    "drop_oldest" se perdería audio, así que aquí el productor espera al decodificador.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, fast: bool = False,
+                 tail_ms: int = 1000, timeout: float = 10.0):
+        self.loop = loop
+        self.fast = fast
+        self.tail_ms = tail_ms
+        self.timeout = timeout
+
+        self.bus = LocalBus()
+        self.actions = Actions(self.bus)
+        self.stt = VoskSTT(on_text=self._on_text, on_partial=self._on_partial)
+        self._set_capture_rate(self.stt.capture_rate)
+        self.rec = _TimedRecognizer(self.stt.rec)
+        self.stt.rec = self.rec
+
+        self.samples: Dict[str, List[float]] = {s: [] for s in STAGES}
+        self.rtf: List[float] = []
+        self.files = 0
+        self.matched = 0
+        self.early = 0
+
+        self._utt_end: Optional[float] = None
+        self._marks: Dict[str, float] = {}
+        self._done = threading.Event()
+
+    def _set_capture_rate(self, rate: int):
+        capacity = int(rate * (AUDIO_BUFFER_MS / 1000)) * 2
+        buffer = AudioRingBuffer(capacity, policy="block", block_timeout=self.timeout)
+        self.stt.set_capture_rate(rate, buffer=buffer)
+
+    def start(self):
+        self.stt._stop.clear()
+        self.stt._worker.start()
+
+    # ---------- Callbacks desde el hilo de STT ----------
+    def _on_partial(self, text: str):
+        self._on_text(text, early=True)
+
+    def _on_text(self, text: str, early: bool = False):
+        t_text = time.perf_counter()
+        if "text" in self._marks:
+            # Sólo medimos la primera frase (o parcial disparado) de cada fichero
+            return
+        match = match_intent(text)
+        t_intent = time.perf_counter()
+        if early and (not match or match[0] not in EARLY_INTENTS):
+            return
+        self._marks.update(text=t_text, intent=t_intent)
+        if not match:
+            print(f"[REPLAY] Sin intent: {text}")
+            self._done.set()
+            return
+        if early:
+            self.early += 1
+        intent, slots = match
+        run_coroutine_threadsafe(self._handle(intent, slots), self.loop)
+
+    async def _handle(self, intent: str, slots: dict):
+        n = len(self.bus.published)
+        try:
+            await self.actions.handle(intent, slots)
+            if len(self.bus.published) > n:
+                self._marks["pub"] = self.bus.published[n][0]
+        finally:
+            self._done.set()
+
+    def _record(self):
+        m, end = self._marks, self._utt_end
+        if "text" not in m:
+            return
+        # Con parciales, stt y total pueden ser negativos: la orden salió antes del fin del WAV
+        self.samples["stt"].append(m["text"] - end)
+        self.samples["intent"].append(m["intent"] - m["text"])
+        if "pub" in m:
+            self.samples["action"].append(m["pub"] - m["intent"])
+            self.samples["total"].append(m["pub"] - end)
+            self.matched += 1
+
+    # ---------- Alimentación ----------
+    def _feed(self, pcm: bytes):
+        block = int(self.stt.capture_rate * (AUDIO_BLOCK_MS / 1000)) * 2
+        period = AUDIO_BLOCK_MS / 1000
+        t_next = time.perf_counter()
+        for i in range(0, len(pcm), block):
+            if not self.fast:
+                t_next += period
+                delay = t_next - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self.stt.q.put(pcm[i:i + block])
+
+    def replay_file(self, path: Path):
+        pcm, rate = read_wav(path)
+        if rate != self.stt.capture_rate:
+            self._set_capture_rate(rate)  # la cola está vacía entre ficheros
+        tail = b"\x00\x00" * int(rate * self.tail_ms / 1000)
+        audio_s = (len(pcm) + len(tail)) / 2 / rate
+
+        self._done.clear()
+        self._marks = {}
+        self._utt_end = None
+        decode_before = self.rec.decode_s
+
+        self._feed(pcm)
+        self._utt_end = time.perf_counter()  # fin de la frase
+        self._feed(tail)  # silencio para que Vosk cierre el endpoint
+
+        if not self._done.wait(self.timeout):
+            print(f"[REPLAY] {path.name}: sin resultado en {self.timeout:.0f}s")
+        self._record()
+        while not self.stt.q.empty():
+            time.sleep(0.01)
+        self.rec.Reset()
+        if self.stt.gate is not None:
+            self.stt.gate.reset()
+
+        self.files += 1
+        self.rtf.append((self.rec.decode_s - decode_before) / audio_s)
+
+
+def report(runner: ReplayRunner):
+    print(f"\n[REPLAY] {runner.files} ficheros, {runner.matched} con publish MQTT "
+          f"({runner.early} disparados con parciales)")
+    print(f"{'etapa':<8}{'n':>5}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage in STAGES:
+        vals = runner.samples[stage]
+        print(f"{stage:<8}{len(vals):>5}"
+              f"{percentile(vals, 50) * 1000:>10.1f}"
+              f"{percentile(vals, 95) * 1000:>10.1f}"
+              f"{percentile(vals, 99) * 1000:>10.1f}")
+    print(f"RTF     p50={percentile(runner.rtf, 50):.3f} p95={percentile(runner.rtf, 95):.3f}")
+    q = runner.stt.q
+    print(f"buffer  overruns={q.overruns} dropped={q.dropped_bytes}B max_depth={q.max_depth}B")
+
+
+async def _main(args):
+    runner = ReplayRunner(asyncio.get_running_loop(), fast=args.fast,
+                          tail_ms=args.tail_ms, timeout=args.timeout)
+    runner.start()
+    for _ in range(args.repeat):
+        for path in args.wavs:
+            await asyncio.to_thread(runner.replay_file, path)
+    report(runner)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay de WAVs y benchmark de latencia del pipeline de voz")
+    parser.add_argument("wavs", nargs="+", type=Path, help="ficheros WAV (una orden por fichero)")
+    parser.add_argument("--fast", action="store_true", help="no respetar el ritmo real del audio")
+    parser.add_argument("--repeat", type=int, default=1, help="veces que se repite la lista")
+    parser.add_argument("--tail-ms", type=int, default=1000, help="silencio añadido tras cada WAV")
+    parser.add_argument("--timeout", type=float, default=10.0, help="espera máxima por fichero (s)")
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,19 @@
 import os
+import re
 import time
 import json
 import threading
-from typing import Optional
+import unicodedata
+from collections import OrderedDict, deque
+from typing import Callable, Optional, Tuple, TYPE_CHECKING
+from urllib.parse import urlsplit
 
 import paho.mqtt.client as mqtt
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth
+
+from metrics import METRICS, serve_http
+
+if TYPE_CHECKING:
+    import spotipy  # se importa de verdad en make_spotify(), al primer uso
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -20,10 +27,27 @@ SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 SPOTIFY_REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI", "http://127.0.0.1:8888/callback")
 SPOTIFY_DEVICE_NAME = os.getenv("SPOTIFY_DEVICE_NAME")  # opcional
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL")  # p.ej. http://127.0.0.1:8899/v1/ con mock_spotify.py (sin OAuth)
 
 SCOPE = "user-read-playback-state,user-modify-playback-state,user-read-currently-playing"
-POLL_INTERVAL = 1.0  # seg
+POLL_INTERVAL = 1.0  # seg: cada cuánto se publica el progreso (extrapolado, sin llamar a la API)
+POLL_HEARTBEAT_S = 15.0  # máximo entre consultas a la API mientras suena algo
+POLL_TRACK_END_MARGIN_S = 0.5  # re-consulta justo después del fin previsto de la pista
+POLL_AFTER_COMMAND_S = 0.5  # consulta poco después de un comando (siguiente, play...)
+POLL_IDLE_MIN_S = 5.0  # en pausa / sin reproducción: espera inicial entre consultas...
+POLL_IDLE_MAX_S = 60.0  # ...que se duplica hasta este máximo
+PROGRESS_PUBLISH_S = 5.0  # cada cuánto se publica el progreso sonando (0 = solo al cambiar pista, pausa o seek)
+SEEK_THRESHOLD_MS = 2000  # desvío respecto a lo extrapolado a partir del cual se considera un seek
+STATE_COMPACT = os.getenv("SPOTIFY_STATE_COMPACT", "0") == "1"  # JSON de estado con claves cortas y sin espacios
 CACHE_PATH = ".cache-spotify"
+SEARCH_CACHE_PATH = os.getenv("SPOTIFY_SEARCH_CACHE", ".cache-search.json")  # "" = solo en memoria
+SEARCH_CACHE_SIZE = 500  # búsquedas recordadas (LRU)
+SEARCH_CACHE_TTL_S = 7 * 24 * 3600  # pasado este tiempo se vuelve a buscar
+TRANSFER_CONFIRM_POLL_S = 0.1  # primera espera antes de comprobar un transfer_playback (se duplica)
+TRANSFER_CONFIRM_TRIES = 3  # comprobaciones como mucho (0.1 + 0.2 + 0.4 s)
+NEXT_MAX_PENDING = 2  # "siguiente" repetidos en cola se agrupan hasta este número
+METRICS_PUBLISH_S = float(os.getenv("SPOTIFY_METRICS_S", "30"))  # JSON en TOPIC_METRICS (0 = nunca)
+METRICS_PORT = int(os.getenv("SPOTIFY_METRICS_PORT", "0")) or None  # endpoint Prometheus /metrics
 
 TOPIC_CMD_PLAY_SONG = f"{BASE}/spotify/play_song"   # payload: texto con nombre de canción
 TOPIC_CMD_RESUME    = f"{BASE}/spotify/play"      # payload: cualquiera
@@ -36,8 +60,51 @@ TOPIC_ALBUM         = f"{BASE}/spotify/track/album"
 TOPIC_COVER         = f"{BASE}/spotify/track/cover"
 TOPIC_PROGRESS      = f"{BASE}/spotify/track/progress_ms"
 TOPIC_DURATION      = f"{BASE}/spotify/track/duration_ms"
+TOPIC_IS_PLAYING    = f"{BASE}/spotify/track/is_playing"
+TOPIC_METRICS       = f"{BASE}/metrics/spotify"
+
+# Campo de estado → topic simple. Se publican retenidos y solo cuando cambian.
+_FIELD_TOPICS = {
+    "title": TOPIC_TITLE,
+    "artists": TOPIC_ARTISTS,
+    "album": TOPIC_ALBUM,
+    "cover_url": TOPIC_COVER,
+    "duration_ms": TOPIC_DURATION,
+    "is_playing": TOPIC_IS_PLAYING,
+}
+# Claves cortas para STATE_COMPACT
+_COMPACT_KEYS = {
+    "id": "i", "title": "t", "artists": "a", "album": "al", "cover_url": "c",
+    "duration_ms": "d", "progress_ms": "p", "uri": "u", "is_playing": "s",
+}
 
-def make_spotify() -> spotipy.Spotify:
+def _record_api_call(response, *args, **kwargs):
+    """Hook de requests: latencia y errores de cada llamada a la Web API."""
+    endpoint = f"{response.request.method} {urlsplit(response.url).path.replace('/v1/', '', 1)}"
+    METRICS.observe("spotify_api_seconds", response.elapsed.total_seconds(), endpoint=endpoint)
+    if response.status_code >= 400:
+        METRICS.inc("spotify_api_errors_total", status=response.status_code)
+
+def make_spotify() -> "spotipy.Spotify":
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    import spotipy
+    from spotipy.oauth2 import SpotifyOAuth
+    # Una sesión HTTP compartida (keep-alive) para el hilo de órdenes y el bucle de estado.
+    # Con sesión propia spotipy no monta su adaptador con reintentos: se replica aquí
+    # (429 y 5xx con espera creciente y respetando Retry-After)
+    session = requests.Session()
+    retry = Retry(total=3, status_forcelist=(429, 500, 502, 503, 504), backoff_factor=0.3,
+                  respect_retry_after_header=True, allowed_methods=False)
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=2, max_retries=retry)
+    session.mount("https://", adapter)
+    session.hooks["response"].append(_record_api_call)
+    if SPOTIFY_API_URL:
+        session.mount("http://", adapter)
+        sp = spotipy.Spotify(auth="mock-token", requests_session=session)
+        sp.prefix = SPOTIFY_API_URL
+        return sp
     return spotipy.Spotify(
         auth_manager=SpotifyOAuth(
             client_id=SPOTIFY_CLIENT_ID,
@@ -46,10 +113,12 @@ def make_spotify() -> spotipy.Spotify:
             scope=SCOPE,
             open_browser=False,
             cache_path=CACHE_PATH,
-        )
+            requests_session=session,
+        ),
+        requests_session=session,
     )
 
-def pick_device_id(sp: spotipy.Spotify) -> Optional[str]:
+def pick_device_id(sp: "spotipy.Spotify") -> Optional[str]:
     """Devuelve el device activo, o el primero disponible. Si SPOTIFY_DEVICE_NAME está definido, lo prioriza."""
     devices = sp.devices().get("devices", [])
     if SPOTIFY_DEVICE_NAME:
@@ -61,6 +130,228 @@ def pick_device_id(sp: spotipy.Spotify) -> Optional[str]:
             return d["id"]
     return devices[0]["id"] if devices else None
 
+def is_device_missing(e: Exception) -> bool:
+    """True si `e` indica que el device ya no existe (apagado, reinstalado...)."""
+    return getattr(e, "http_status", None) == 404 or "device not found" in str(e).lower()
+
+# Solo muletillas del STT que nunca forman parte de un título: artículos y palabras
+# como "este" o "vale" se quedan ("La Bamba", "Este amor" y "Vale la pena" son títulos)
+_FILLER_RX = re.compile(r"\b(eh+|em+|mm+|porfa|por favor)\b")
+_LEADING_RX = re.compile(r"^((la|una)\s+)?cancion\s+de\s+")
+_NON_WORD_RX = re.compile(r"[^\w\s]")
+
+def normalize_query(query: str) -> str:
+    """
+    Clave de caché de una búsqueda: sin tildes ni mayúsculas, sin puntuación, sin
+    muletillas y sin 'la canción de...' inicial ('la canción de Rosalía, porfa' y
+    'rosalia' comparten entrada).
+    """
+    text = unicodedata.normalize("NFKD", query.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = _NON_WORD_RX.sub(" ", text)
+    text = _FILLER_RX.sub(" ", text)
+    text = " ".join(text.split())
+    return _LEADING_RX.sub("", text, count=1).strip() or text
+
+class SearchCache:
+    """
+    Consulta normalizada → (uri, nombre) de la pista, con LRU de `size` entradas y
+    caducidad `ttl_s`. Se guarda en `path` (JSON) para que sobreviva a reinicios.
+    """
+    def __init__(self, path: Optional[str] = SEARCH_CACHE_PATH, size: int = SEARCH_CACHE_SIZE,
+                 ttl_s: float = SEARCH_CACHE_TTL_S):
+        self.path = path
+        self.size = size
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+        # clave → [uri, nombre, instante (epoch) en que se guardó]
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load()
+
+    def get(self, query: str) -> Optional[Tuple[str, str]]:
+        key = normalize_query(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[2] > self.ttl_s:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, query: str, uri: str, name: str):
+        key = normalize_query(query)
+        with self._lock:
+            self._entries[key] = [uri, name, time.time()]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+            self._save()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[SPOTIFY] Caché de búsquedas ilegible ({e}), se empieza de cero")
+            return
+        now = time.time()
+        # El fichero se guarda de menos a más reciente: el orden LRU se conserva
+        for key, entry in data.items():
+            if now - entry[2] <= self.ttl_s:
+                self._entries[key] = entry
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp = f"{self.path}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp, self.path)  # atómico: un corte no deja el fichero a medias
+        except OSError as e:
+            print(f"[SPOTIFY] No se pudo guardar la caché de búsquedas: {e}")
+
+class PlaybackTracker:
+    """
+    Último estado de reproducción conocido y cuándo volver a pedirlo a la API.
+    El progreso se extrapola localmente desde la última consulta; solo se re-consulta
+    cerca del fin de pista, tras un comando, por latido (POLL_HEARTBEAT_S) o, en pausa,
+    con espera exponencial. Un 429 retrasa la siguiente consulta lo que diga Retry-After.
+    """
+    def __init__(self):
+        self.pb: Optional[dict] = None
+        self.fetched_at = 0.0
+        self.next_poll = 0.0
+        self._idle_delay = POLL_IDLE_MIN_S
+        self._lock = threading.Lock()
+
+    @property
+    def playing(self) -> bool:
+        return bool(self.pb and self.pb.get("is_playing") and self.pb.get("item"))
+
+    def due(self) -> bool:
+        return time.monotonic() >= self.next_poll
+
+    def update(self, pb: Optional[dict]):
+        now = time.monotonic()
+        with self._lock:
+            self.pb = pb
+            self.fetched_at = now
+            if self.playing:
+                self._idle_delay = POLL_IDLE_MIN_S
+                item = pb["item"]
+                remaining_s = ((item.get("duration_ms") or 0) - (pb.get("progress_ms") or 0)) / 1000
+                delay = min(POLL_HEARTBEAT_S, max(remaining_s, 0) + POLL_TRACK_END_MARGIN_S)
+            else:
+                delay = self._idle_delay
+                self._idle_delay = min(self._idle_delay * 2, POLL_IDLE_MAX_S)
+            self.next_poll = now + delay
+
+    def poke(self, delay: float = POLL_AFTER_COMMAND_S):
+        """Tras un comando: el estado va a cambiar, consulta pronto y sal del modo inactivo."""
+        with self._lock:
+            self.next_poll = min(self.next_poll, time.monotonic() + delay)
+            self._idle_delay = POLL_IDLE_MIN_S
+
+    def backoff(self, seconds: float):
+        with self._lock:
+            self.next_poll = max(self.next_poll, time.monotonic() + seconds)
+
+    def progress_ms(self) -> int:
+        if not self.pb:
+            return 0
+        progress = self.pb.get("progress_ms") or 0
+        if self.playing:
+            progress += int((time.monotonic() - self.fetched_at) * 1000)
+            progress = min(progress, self.pb["item"].get("duration_ms") or progress)
+        return progress
+
+    def sleep_time(self) -> float:
+        until_poll = max(0.0, self.next_poll - time.monotonic())
+        # Sonando: despierta cada POLL_INTERVAL para publicar el progreso extrapolado
+        return min(POLL_INTERVAL, until_poll) if self.playing else until_poll
+
+def retry_after(e: Exception) -> Optional[float]:
+    """Segundos de Retry-After si `e` es un 429 de spotipy; None si es otro error."""
+    if getattr(e, "http_status", None) != 429:
+        return None
+    headers = getattr(e, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After", 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+class CommandQueue:
+    """
+    Órdenes MQTT pendientes, ejecutadas en orden de llegada por un único hilo fuera del
+    hilo de red de paho (en paralelo, un "siguiente" podría adelantarse a un play_song
+    aún buscando y perderse). Se coalescen mientras esperan: una orden `repeat`
+    (siguiente) seguida de otra igual acumula repeticiones hasta `max_repeat`; el resto
+    sustituye a la pendiente del mismo topic y pasa al final (un play_song nuevo
+    reemplaza al que aún no ha empezado).
+    """
+    def __init__(self, handler: Callable[[str, str, Optional[str]], None], max_repeat: int = NEXT_MAX_PENDING):
+        self._handler = handler
+        self.max_repeat = max_repeat
+        self.coalesced = 0
+        # [topic, payload, repeticiones, traza, instante de llegada], en orden de llegada
+        self._pending: "deque[list]" = deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def submit(self, topic: str, payload: str, repeat: bool = False, trace: Optional[str] = None):
+        with self._cond:
+            last = self._pending[-1] if self._pending else None
+            if repeat and last is not None and last[0] == topic:
+                self.coalesced += 1
+                last[2] = min(last[2] + 1, self.max_repeat)
+            else:
+                if not repeat:
+                    for entry in self._pending:
+                        if entry[0] == topic:
+                            self._pending.remove(entry)
+                            self.coalesced += 1
+                            break
+                self._pending.append([topic, payload, 1, trace, time.perf_counter()])
+            self._cond.notify()
+
+    def _take(self) -> Optional[list]:
+        with self._cond:
+            while not self._stopped:
+                if self._pending:
+                    return self._pending.popleft()
+                self._cond.wait()
+            return None
+
+    def _worker(self):
+        while True:
+            job = self._take()
+            if job is None:
+                return
+            topic, payload, times, trace, received = job
+            METRICS.observe("spotify_command_wait_seconds", time.perf_counter() - received,
+                            command=topic.rsplit("/", 1)[-1])
+            for _ in range(times):
+                self._handler(topic, payload, trace)
+
 class SimpleSpotifyAgent:
     def __init__(self):
         self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5)
@@ -68,12 +359,18 @@ class SimpleSpotifyAgent:
         self.client.on_message = self._on_message
         self.client.on_disconnect = self._on_disconnect
 
-        self.sp: Optional[spotipy.Spotify] = None
+        self.sp: Optional["spotipy.Spotify"] = None
+        self._sp_lock = threading.Lock()
         self.device_id: Optional[str] = None
+        self.commands = CommandQueue(self._run_command)
+        self.search_cache = SearchCache()
 
-        # cache para no spamear MQTT
-        self._last_track_id = None
-        self._last_bucket = None  # progreso redondeado a segundos
+        # último estado publicado, para enviar solo lo que cambia
+        self._published: dict = {}
+        self._progress_sent_at = 0.0
+
+        self.tracker = PlaybackTracker()
+        self._wake = threading.Event()  # interrumpe la espera del bucle de estado tras un comando
 
         self._stop = threading.Event()
 
@@ -92,42 +389,107 @@ class SimpleSpotifyAgent:
         print(f"[MQTT] Desconectado (code={code})")
 
     def _on_message(self, client, userdata, msg):
+        # Solo encola: el hilo de paho no debe bloquearse con llamadas HTTP
         payload = msg.payload.decode("utf-8").strip()
-        try:
+        props = dict(getattr(getattr(msg, "properties", None), "UserProperty", None) or [])
+        self.commands.submit(msg.topic, payload, repeat=msg.topic == TOPIC_CMD_NEXT, trace=props.get("trace"))
+
+    def _spotify(self) -> "spotipy.Spotify":
+        with self._sp_lock:
             if self.sp is None:
                 self.sp = make_spotify()
+            return self.sp
+
+    def _run_command(self, topic: str, payload: str, trace: Optional[str] = None):
+        command = topic.rsplit("/", 1)[-1]
+        if trace:
+            print(f"[SPOTIFY] Orden {command} [{trace}]")
+        t0 = time.perf_counter()
+        try:
+            self._spotify()
             if self.device_id is None:
                 self.device_id = pick_device_id(self.sp)
                 if not self.device_id:
                     print("[SPOTIFY] No hay dispositivos Connect disponibles")
                     return
 
-            if msg.topic == TOPIC_CMD_PLAY_SONG:
+            if topic == TOPIC_CMD_PLAY_SONG:
                 self.play_song_by_name(payload)
-            elif msg.topic == TOPIC_CMD_NEXT:
-                self.sp.next_track(device_id=self.device_id)
-            elif msg.topic == TOPIC_CMD_RESUME:
+            elif topic == TOPIC_CMD_NEXT:
+                self.next_track()
+            elif topic == TOPIC_CMD_RESUME:
                 self.resume_playback()  
+            self.tracker.poke()
+            self._wake.set()
         except Exception as e:
-            print(f"[SPOTIFY] Error mensaje: {e}")
+            METRICS.inc("spotify_command_errors_total", command=command)
+            print(f"[SPOTIFY] Error mensaje: {e}" + (f" [{trace}]" if trace else ""))
+        finally:
+            METRICS.observe("spotify_command_seconds", time.perf_counter() - t0, command=command)
+
+    # ---- Device ----
+    def _active_device_id(self) -> Optional[str]:
+        return ((self.tracker.pb or {}).get("device") or {}).get("id")
+
+    def _ensure_device(self, force: bool = False):
+        """
+        Lleva la reproducción al device elegido si no está ya en él (según el último
+        estado conocido, o siempre con `force`) y comprueba unas pocas veces, con espera creciente, que Spotify
+        lo confirma. Si no hay nada cargado (current_playback() es None) no hay nada que
+        confirmar: la orden siguiente ya lleva device_id.
+        """
+        if not force and self._active_device_id() == self.device_id:
+            return
+        self.sp.transfer_playback(device_id=self.device_id, force_play=False)
+        delay = TRANSFER_CONFIRM_POLL_S
+        for _ in range(TRANSFER_CONFIRM_TRIES):
+            time.sleep(delay)
+            pb = self.sp.current_playback()
+            self.tracker.update(pb)
+            if pb is None or self._active_device_id() == self.device_id:
+                return
+            delay *= 2
+        print("[SPOTIFY] Transferencia sin confirmar, se continúa igualmente")
+
+    def _on_device(self, command: Callable[[], None]):
+        """
+        Ejecuta `command` en el device elegido. Si Spotify responde que el device ya no
+        existe, refresca la lista de dispositivos y lo reintenta una vez.
+        """
+        try:
+            self._ensure_device()
+            command()
+        except Exception as e:
+            if not is_device_missing(e):
+                raise
+            print("[SPOTIFY] Device no encontrado, refrescando dispositivos")
+            self.device_id = pick_device_id(self.sp)
+            if not self.device_id:
+                raise
+            # El device suele volver con el mismo id (p.ej. librespot reiniciado) y el
+            # estado guardado aún lo da por activo: hay que transferir sí o sí
+            self._ensure_device(force=True)
+            command()
 
     # ---- Acciones ----
     def play_song_by_name(self, query: str):
         if not query:
             print("[SPOTIFY] play_song vacío")
             return
-        res = self.sp.search(q=query, type="track", limit=1)
-        items = (res.get("tracks") or {}).get("items") or []
-        if not items:
-            print(f"[SPOTIFY] No encontré: {query}")
-            return
-        uri = items[0]["uri"]
-        # asegúrate de transferir al device
-        self.sp.transfer_playback(device_id=self.device_id, force_play=False)
-        time.sleep(0.2)
-        self.sp.start_playback(device_id=self.device_id, uris=[uri])
-        print(f"[SPOTIFY] Reproduciendo: {items[0]['name']}")
-    
+        cached = self.search_cache.get(query)
+        if cached:
+            uri, name = cached
+        else:
+            res = self.sp.search(q=query, type="track", limit=1)
+            items = (res.get("tracks") or {}).get("items") or []
+            if not items:
+                print(f"[SPOTIFY] No encontré: {query}")
+                return
+            uri, name = items[0]["uri"], items[0]["name"]
+            self.search_cache.put(query, uri, name)
+        self._on_device(lambda: self.sp.start_playback(device_id=self.device_id, uris=[uri]))
+        print(f"[SPOTIFY] Reproduciendo: {name}" + (" (caché)" if cached else ""))
+
     def resume_playback(self):
         """
         Reanuda lo último que se estaba reproduciendo.
@@ -135,45 +497,40 @@ class SimpleSpotifyAgent:
         - Si no hay playback activo: toma la última canción reproducida y la lanza.
         """
         try:
-            # Garantiza que el audio salga por el device elegido
-            self.sp.transfer_playback(device_id=self.device_id, force_play=False)
-            time.sleep(0.2)
-
-            pb = self.sp.current_playback()
-            if pb and not pb.get("is_playing", False):
-                # Hay algo pausado: reanuda en el contexto actual (playlist/album/cola)
-                self.sp.start_playback(device_id=self.device_id)
-                print("[SPOTIFY] Reanudando reproducción anterior")
-                return
-
-            if not pb:
-                # No hay playback: usa la última canción reproducida como fallback
-                recent = self.sp.current_user_recently_played(limit=1)
-                items = (recent or {}).get("items") or []
-                if items:
-                    last_track = (items[0].get("track") or {})
-                    uri = last_track.get("uri")
-                    if uri:
-                        self.sp.start_playback(device_id=self.device_id, uris=[uri])
-                        print(f"[SPOTIFY] Reproduciendo lo último escuchado: {last_track.get('name','')}")
-                        return
-
-            # Si ya está reproduciendo, no hacemos nada
-            print("[SPOTIFY] Ya se está reproduciendo música")
+            self._on_device(self._resume)
         except Exception as e:
             print(f"[SPOTIFY] Error al reanudar: {e}")
 
+    def _resume(self):
+        pb = self.sp.current_playback()
+        if pb and not pb.get("is_playing", False):
+            # Hay algo pausado: reanuda en el contexto actual (playlist/album/cola)
+            self.sp.start_playback(device_id=self.device_id)
+            print("[SPOTIFY] Reanudando reproducción anterior")
+            return
+
+        if not pb:
+            # No hay playback: usa la última canción reproducida como fallback
+            recent = self.sp.current_user_recently_played(limit=1)
+            items = (recent or {}).get("items") or []
+            if items:
+                last_track = (items[0].get("track") or {})
+                uri = last_track.get("uri")
+                if uri:
+                    self.sp.start_playback(device_id=self.device_id, uris=[uri])
+                    print(f"[SPOTIFY] Reproduciendo lo último escuchado: {last_track.get('name','')}")
+                    return
+
+        # Si ya está reproduciendo, no hacemos nada
+        print("[SPOTIFY] Ya se está reproduciendo música")
+
     def next_track(self):
         """
-        Salta a la siguiente pista en el dispositivo activo.
-        - Transfiere la sesión al device elegido (por si estás controlando otro).
-        - Lanza 'next' en ese device.
+        Salta a la siguiente pista en el device elegido (transfiriendo antes la sesión
+        solo si se está reproduciendo en otro).
         """
         try:
-            # Asegura que el playback está en el device seleccionado
-            self.sp.transfer_playback(device_id=self.device_id, force_play=False)
-            time.sleep(0.15)
-            self.sp.next_track(device_id=self.device_id)
+            self._on_device(lambda: self.sp.next_track(device_id=self.device_id))
             print("[SPOTIFY] Siguiente pista ▶▶")
         except Exception as e:
             print(f"[SPOTIFY] Error al pasar a la siguiente pista: {e}")
@@ -182,63 +539,104 @@ class SimpleSpotifyAgent:
     def publish_state_loop(self):
         while not self._stop.is_set():
             try:
-                if self.sp is None:
-                    self.sp = make_spotify()
-                pb = self.sp.current_playback()
-                if not pb:
-                    time.sleep(POLL_INTERVAL)
-                    continue
-
-                item = pb.get("item") or {}
-                if not item:
-                    time.sleep(POLL_INTERVAL)
-                    continue
-
-                track_id = item.get("id")
-                name = item.get("name") or ""
-                artists = ", ".join([a.get("name") for a in item.get("artists", [])])
-                album = (item.get("album") or {}).get("name") or ""
-                images = (item.get("album") or {}).get("images") or []
-                cover_url = images[0]["url"] if images else ""
-                duration_ms = item.get("duration_ms") or 0
-                progress_ms = pb.get("progress_ms") or 0
-
-                # Publica solo si cambia pista o segundo
-                bucket = progress_ms // 1000
-                changed = (track_id != self._last_track_id) or (bucket != self._last_bucket)
-                if changed:
-                    self._last_track_id = track_id
-                    self._last_bucket = bucket
-
-                    self.client.publish(TOPIC_TITLE, name, qos=0, retain=False)
-                    self.client.publish(TOPIC_ARTISTS, artists, qos=0, retain=False)
-                    self.client.publish(TOPIC_ALBUM, album, qos=0, retain=False)
-                    self.client.publish(TOPIC_COVER, cover_url, qos=0, retain=False)
-                    self.client.publish(TOPIC_DURATION, str(duration_ms), qos=0, retain=False)
-                    self.client.publish(TOPIC_PROGRESS, str(progress_ms), qos=0, retain=False)
-
-                    payload = {
-                        "id": track_id,
-                        "title": name,
-                        "artists": artists,
-                        "album": album,
-                        "cover_url": cover_url,
-                        "duration_ms": duration_ms,
-                        "progress_ms": progress_ms,
-                        "uri": item.get("uri"),
-                    }
-                    self.client.publish(TOPIC_STATE_JSON, json.dumps(payload, ensure_ascii=False), qos=0, retain=False)
-
+                self._spotify()
+                seek = False
+                if self.tracker.due():
+                    expected = self.tracker.progress_ms() if self.tracker.playing else None
+                    self.tracker.update(self.sp.current_playback())
+                    seek = (expected is not None and self.tracker.playing
+                            and abs(self.tracker.progress_ms() - expected) > SEEK_THRESHOLD_MS)
+                if self.tracker.pb and self.tracker.pb.get("item"):
+                    self._publish_state(self.tracker.pb, self.tracker.progress_ms(), seek)
+                elif self._published:
+                    self._clear_state()
             except Exception as e:
-                print(f"[SPOTIFY] Error estado: {e}")
-                time.sleep(1.5)
-            time.sleep(POLL_INTERVAL)
+                wait = retry_after(e)
+                if wait is not None:
+                    METRICS.inc("spotify_rate_limited_total")
+                    print(f"[SPOTIFY] Rate limit (429): reintento en {wait:.0f}s")
+                    self.tracker.backoff(wait)
+                else:
+                    print(f"[SPOTIFY] Error estado: {e}")
+                    self.tracker.backoff(1.5)
+            self._wake.wait(self.tracker.sleep_time())
+            self._wake.clear()
+
+    def _publish_state(self, pb: dict, progress_ms: int, seek: bool = False):
+        """
+        Publica solo lo que cambia: los campos de la pista van retenidos y una vez por
+        pista; el progreso (y el JSON completo) cada PROGRESS_PUBLISH_S, o al momento
+        si cambia la pista, se pausa/reanuda o hay un seek.
+        """
+        item = pb.get("item") or {}
+        images = (item.get("album") or {}).get("images") or []
+        state = {
+            "id": item.get("id"),
+            "title": item.get("name") or "",
+            "artists": ", ".join([a.get("name") for a in item.get("artists", [])]),
+            "album": (item.get("album") or {}).get("name") or "",
+            "cover_url": images[0]["url"] if images else "",
+            "duration_ms": item.get("duration_ms") or 0,
+            "uri": item.get("uri"),
+            "is_playing": bool(pb.get("is_playing")),
+        }
+        changed = {k: v for k, v in state.items() if self._published.get(k) != v}
+        for key, value in changed.items():
+            topic = _FIELD_TOPICS.get(key)
+            if topic:
+                text = ("true" if value else "false") if isinstance(value, bool) else str(value)
+                self.client.publish(topic, text, qos=0, retain=True)
+        self._published.update(changed)
+
+        now = time.monotonic()
+        progress_due = (state["is_playing"] and PROGRESS_PUBLISH_S > 0
+                        and now - self._progress_sent_at >= PROGRESS_PUBLISH_S)
+        if not (changed or seek or progress_due):
+            return
+        self._progress_sent_at = now
+        self.client.publish(TOPIC_PROGRESS, str(progress_ms), qos=0, retain=False)
+
+        payload = dict(state, progress_ms=progress_ms)
+        if STATE_COMPACT:
+            payload = {_COMPACT_KEYS[k]: v for k, v in payload.items()}
+            text = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+        else:
+            text = json.dumps(payload, ensure_ascii=False)
+        self.client.publish(TOPIC_STATE_JSON, text, qos=0, retain=True)
+
+    def _clear_state(self):
+        """
+        Sin reproducción (204, device apagado...): is_playing=false y se borran los
+        retenidos de la pista (payload vacío), para que nadie vea la última como sonando.
+        """
+        self.client.publish(TOPIC_IS_PLAYING, "false", qos=0, retain=True)
+        for topic in _FIELD_TOPICS.values():
+            if topic != TOPIC_IS_PLAYING:
+                self.client.publish(topic, "", qos=0, retain=True)
+        self.client.publish(TOPIC_STATE_JSON, "", qos=0, retain=True)
+        self._published = {}
+
+    # ---- Métricas ----
+    def _collect_metrics(self, metrics):
+        metrics.set("spotify_commands_coalesced", self.commands.coalesced)
+        metrics.set("spotify_search_cache_hits", self.search_cache.hits)
+        metrics.set("spotify_search_cache_misses", self.search_cache.misses)
+
+    def _metrics_loop(self):
+        while not self._stop.wait(METRICS_PUBLISH_S):
+            self.client.publish(TOPIC_METRICS, METRICS.to_json(), qos=0, retain=False)
 
     # ---- Ciclo ----
     def start(self):
-        if not (SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET and SPOTIFY_REDIRECT_URI):
+        if not SPOTIFY_API_URL and not (SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET and SPOTIFY_REDIRECT_URI):
             print("[SPOTIFY] Faltan credenciales. Exporta SPOTIFY_CLIENT_ID/SECRET/REDIRECT_URI")
             return
+        self.commands.start()
+        METRICS.add_collector(self._collect_metrics)
+        if METRICS_PORT:
+            serve_http(METRICS, METRICS_PORT)
+        if METRICS_PUBLISH_S > 0:
+            threading.Thread(target=self._metrics_loop, daemon=True).start()
         self.client.connect(MQTT_HOST, MQTT_PORT, 60)
         t = threading.Thread(target=self.client.loop_forever, daemon=True)
         t.start()
@@ -248,6 +646,7 @@ class SimpleSpotifyAgent:
             pass
         finally:
             self._stop.set()
+            self.commands.stop()
             self.client.disconnect()
 
 if __name__ == "__main__":
@@ -1,66 +1,373 @@
-import queue
 import threading
-import sounddevice as sd
 import json
-from vosk import Model, KaldiRecognizer
-from typing import Callable
-from config import SAMPLE_RATE, AUDIO_BLOCK_MS, VOSK_MODEL_PATH, DEBUG_LOG
+import math
+import time
+from collections import OrderedDict, deque
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Union
+from config import (
+    SAMPLE_RATE, CAPTURE_SAMPLE_RATE, AUDIO_BLOCK_MS, AUDIO_BUFFER_MS, AUDIO_OVERFLOW_POLICY,
+    VOSK_MODEL_PATH, DEBUG_LOG, STT_STREAMING, PARTIAL_STABLE_BLOCKS, STT_COMMAND_MODE, SLOT_VOCAB_SIZE,
+    VAD_ENABLED, VAD_MODE, VAD_THRESHOLD_DB, VAD_NOISE_MARGIN_DB, VAD_MAX_ZCR,
+    VAD_HANGOVER_MS, VAD_PREROLL_MS, STT_ROOMS, STT_PROCESS,
+    WAKE_WORD_ENABLED, WAKE_WORDS, WAKE_WINDOW_MS, WAKE_REPLAY_MS,
+)
+from audio import AudioRingBuffer, PolyphaseResampler, VoiceGate
+from intents import grammar_phrases, needs_open_vocabulary
+from metrics import METRICS, RATIO_BUCKETS
+
+# vosk se importa al usarse: importar stt.py es barato y el modelo puede cargarse
+# en segundo plano mientras se conecta MQTT (ver main.py)
+_MODELS: Dict[str, "Model"] = {}
+_MODELS_LOCK = threading.Lock()
+
+def load_model(path: Path = VOSK_MODEL_PATH) -> "Model":
+    """
+    Carga el modelo Vosk una sola vez por proceso. Un Model se puede compartir entre
+    varios KaldiRecognizer (uno por micro) y entre hilos.
+    """
+    with _MODELS_LOCK:
+        key = str(path)
+        if key not in _MODELS:
+            if not path.exists():
+                raise FileNotFoundError(
+                    f"No se encontró el modelo Vosk en {path}. "
+                    "Descárgalo y ajusta la ruta en config.py."
+                )
+            from vosk import Model
+            _MODELS[key] = Model(key)
+        return _MODELS[key]
 
 class VoskSTT:
     """
     Captura audio del micro y emite frases reconocidas (texto) vía callback.
-    Usa VAD interno de Vosk por bloques; simple y robusto para empezar.
+    Una puerta de voz (VoiceGate) descarta el silencio antes de Vosk; dentro de
+    cada frase, el endpointing lo sigue haciendo Vosk.
+    Con STT_STREAMING, on_partial recibe los parciales que se mantienen estables
+    PARTIAL_STABLE_BLOCKS bloques (cada texto distinto una sola vez por frase).
+    Con STT_COMMAND_MODE, self.rec decodifica con una gramática generada de los
+    intents y self.open_rec (vocabulario abierto) solo redecodifica 'pon <canción>'.
+    Con WAKE_WORD_ENABLED, un recognizer con gramática de solo WAKE_WORDS escucha
+    mientras tanto y el principal solo recibe audio tras oír la palabra, hasta que
+    emite una frase o pasan WAKE_WINDOW_MS sin orden.
+    on_end se llama al cerrar cada frase, también si el texto final queda vacío
+    (tras quitar [unk] o la palabra de activación) y on_text no llega a llamarse.
     """
-    def __init__(self, on_text: Callable[[str], None]):
-        if not VOSK_MODEL_PATH.exists():
-            raise FileNotFoundError(
-                f"No se encontró el modelo Vosk en {VOSK_MODEL_PATH}. "
-                "Descárgalo y ajusta la ruta en config.py."
-            )
-        self.model = Model(str(VOSK_MODEL_PATH))
+    def __init__(self, on_text: Callable[[str], None], on_partial: Optional[Callable[[str], None]] = None,
+                 device: Union[int, str, None] = None, room: Optional[str] = None,
+                 on_end: Optional[Callable[[], None]] = None):
+        from vosk import KaldiRecognizer
+        self.model = load_model()
+        self.device = device  # dispositivo de entrada de sounddevice (None = el de por defecto)
+        self.room = room
+        self._tag = f"[STT:{room}]" if room else "[STT]"
+        self._stream = None
         self.rec = KaldiRecognizer(self.model, SAMPLE_RATE)
         self.rec.SetWords(True)  # opcional
+        self.open_rec = None
+        self._slot_values: "OrderedDict[str, None]" = OrderedDict()
+        self._grammar_dirty = False
+        self._slot_lock = threading.Lock()
+        self._utt_audio: List[bytes] = []
+        if STT_COMMAND_MODE:
+            self.open_rec = self.rec
+            self.rec = KaldiRecognizer(self.model, SAMPLE_RATE, json.dumps(grammar_phrases(), ensure_ascii=False))
+            self.rec.SetWords(True)
+        self.wake_rec = None
+        self._awake = True
+        self._wake_deadline = 0.0  # time.monotonic() en que caduca la ventana de orden
+        self._wake_history: "deque[bytes]" = deque(maxlen=max(1, math.ceil(WAKE_REPLAY_MS / AUDIO_BLOCK_MS)))
+        if WAKE_WORD_ENABLED:
+            self.wake_rec = KaldiRecognizer(self.model, SAMPLE_RATE,
+                                            json.dumps(list(WAKE_WORDS) + ["[unk]"], ensure_ascii=False))
+            self._awake = False
         self.on_text = on_text
+        self.on_partial = on_partial if STT_STREAMING else None
+        self.on_end = on_end
+        self._partial = ""
+        self._partial_blocks = 0
+        self._partial_sent = ""
+        self.q = None
+        self.set_capture_rate(CAPTURE_SAMPLE_RATE or SAMPLE_RATE)
+        self.gate = VoiceGate(
+            SAMPLE_RATE, AUDIO_BLOCK_MS, mode=VAD_MODE,
+            threshold_db=VAD_THRESHOLD_DB, noise_margin_db=VAD_NOISE_MARGIN_DB, max_zcr=VAD_MAX_ZCR,
+            hangover_ms=VAD_HANGOVER_MS, preroll_ms=VAD_PREROLL_MS,
+        ) if VAD_ENABLED else None
 
-        self.q = queue.Queue()
         self._stop = threading.Event()
         self._worker = threading.Thread(target=self._recognize_loop, daemon=True)
 
+    def set_capture_rate(self, rate: int, buffer=None):
+        """
+        Frecuencia a la que llega el audio. Se remuestrea a SAMPLE_RATE antes de Vosk,
+        así el micro captura a su frecuencia nativa y Kaldi extrae features a 16k.
+        `buffer`: buffer ya creado por quien captura (p.ej. un SharedAudioRing).
+        """
+        self.capture_rate = int(rate)
+        self.resampler = PolyphaseResampler(self.capture_rate, SAMPLE_RATE)
+        self._block_bytes = int(self.capture_rate * (AUDIO_BLOCK_MS / 1000)) * 2
+        capacity = int(self.capture_rate * (AUDIO_BUFFER_MS / 1000)) * 2
+        if buffer is not None:
+            self.q = buffer
+        elif self.q is None or self.q.capacity != capacity:
+            self.q = AudioRingBuffer(capacity, policy=AUDIO_OVERFLOW_POLICY)
+
+    def prewarm(self, ms: int = 300):
+        """
+        Pasa un poco de silencio por los recognizers y los reinicia, para que la primera
+        orden real no pague las reservas de memoria e inicializaciones perezosas de Kaldi.
+        """
+        silence = b"\x00\x00" * int(SAMPLE_RATE * ms / 1000)
+        for rec in (self.rec, self.open_rec, self.wake_rec):
+            if rec is not None:
+                rec.AcceptWaveform(silence)
+                rec.Reset()
+
+    def add_slot_values(self, values: Iterable[str]):
+        """
+        Añade valores de slot (p.ej. artistas recién escuchados) a la gramática del modo
+        comando. Se aplica en el hilo de Vosk al terminar la frase en curso.
+        """
+        if self.open_rec is None:
+            return
+        with self._slot_lock:
+            for v in values:
+                v = v.strip().lower()
+                if not v:
+                    continue
+                if v not in self._slot_values:
+                    self._grammar_dirty = True
+                self._slot_values[v] = None
+                self._slot_values.move_to_end(v)
+            while len(self._slot_values) > SLOT_VOCAB_SIZE:
+                self._slot_values.popitem(last=False)
+
     def start(self):
-        if DEBUG_LOG: print("[STT] Iniciando captura de audio…")
+        # Import diferido: el modo replay usa VoskSTT sin micrófono ni PortAudio
+        import sounddevice as sd
+        rate = CAPTURE_SAMPLE_RATE or sd.query_devices(self.device, kind="input")["default_samplerate"]
+        self.set_capture_rate(rate)
+        if DEBUG_LOG: print(f"{self._tag} Iniciando captura de audio ({self.capture_rate} Hz → {SAMPLE_RATE} Hz)…")
         self._stop.clear()
         self._worker.start()
-        sd.InputStream(
-            samplerate=SAMPLE_RATE,
+        self._stream = sd.InputStream(
+            device=self.device,
+            samplerate=self.capture_rate,
             channels=1,
             dtype="int16",
-            blocksize=int(SAMPLE_RATE * (AUDIO_BLOCK_MS / 1000)),
+            blocksize=int(self.capture_rate * (AUDIO_BLOCK_MS / 1000)),
             callback=self._audio_callback,
-        ).start()
+        )
+        self._stream.start()
 
     def stop(self):
         self._stop.set()
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
 
     def _audio_callback(self, indata, frames, time, status):
         if status:
             print(f"[Audio] Estado: {status}")
-        self.q.put(bytes(indata))
+        self.q.put(indata)  # copia al buffer preasignado, sin reservar memoria
+
+    def _emit(self, result: str):
+        self._partial, self._partial_blocks, self._partial_sent = "", 0, ""
+        try:
+            text = json.loads(result).get("text", "").strip()
+        except json.JSONDecodeError:
+            text = ""
+        if self.open_rec is not None:
+            text = self._finish_command(text)
+        if self.wake_rec is not None:
+            text = " ".join(w for w in text.split() if w not in WAKE_WORDS)
+        if text:
+            if DEBUG_LOG: print(f"{self._tag} Frase: {text}")
+            self.on_text(text)
+            if self.wake_rec is not None:
+                self._sleep()  # una orden por activación
+        if self.on_end is not None:
+            self.on_end()
+
+    def _finish_command(self, text: str) -> str:
+        """Cierra una frase del modo comando: fallback a vocabulario abierto y gramática nueva."""
+        audio, self._utt_audio = self._utt_audio, []
+        if needs_open_vocabulary(text):
+            for block in audio:
+                self.open_rec.AcceptWaveform(block)
+            text = json.loads(self.open_rec.FinalResult()).get("text", "").strip()
+            if DEBUG_LOG: print(f"{self._tag} Vocabulario abierto: {text}")
+        if self._grammar_dirty:
+            with self._slot_lock:
+                self._grammar_dirty = False
+                values = list(self._slot_values)
+            self.rec.SetGrammar(json.dumps(grammar_phrases(values), ensure_ascii=False))
+        return " ".join(w for w in text.split() if w != "[unk]")
+
+    # ---------- Palabra de activación ----------
+    @staticmethod
+    def _has_wake_word(result: str, key: str) -> bool:
+        try:
+            words = json.loads(result).get(key, "").split()
+        except json.JSONDecodeError:
+            return False
+        return any(w in WAKE_WORDS for w in words)
+
+    def _listen_for_wake_word(self, block: bytes, final: bool = False):
+        """
+        Pasa el audio solo por el recognizer de la palabra de activación.
+        `final`: la puerta de voz cerró la frase, se mira el resultado definitivo.
+        """
+        if final:
+            self._wake_history.clear()
+            if self._has_wake_word(self.wake_rec.FinalResult(), "text"):
+                self._wake(replay=False)  # "Daisy." y pausa: la orden vendrá en la frase siguiente
+            return
+        self._wake_history.append(block)
+        if self.wake_rec.AcceptWaveform(block):
+            heard = self._has_wake_word(self.wake_rec.Result(), "text")
+        else:
+            heard = self._has_wake_word(self.wake_rec.PartialResult(), "partial")
+        if heard:
+            self._wake(replay=True)
+
+    def _wake(self, replay: bool):
+        self._awake = True
+        self._wake_deadline = time.monotonic() + WAKE_WINDOW_MS / 1000
+        self.wake_rec.Reset()
+        self.rec.Reset()
+        METRICS.inc("wake_words_total", room=self.room)
+        if DEBUG_LOG: print(f"{self._tag} Palabra de activación: escuchando orden…")
+        # La orden suele ir pegada a la palabra ("Daisy, pon Spotify"): los últimos
+        # WAKE_REPLAY_MS que ya se llevó el recognizer de activación se repiten al principal
+        history = list(self._wake_history) if replay else []
+        self._wake_history.clear()
+        for block in history:
+            if not self._awake:
+                break
+            self._decode(block)
+
+    def _sleep(self):
+        self._awake = False
+        self._partial, self._partial_blocks, self._partial_sent = "", 0, ""
+        self._utt_audio = []
+        self.rec.Reset()
+        if DEBUG_LOG: print(f"{self._tag} Esperando palabra de activación")
+
+    def _window_expired(self) -> bool:
+        """
+        La ventana cuenta tiempo real, no audio decodificado: con la puerta de voz el
+        silencio no llega a Vosk y, si no, nunca caducaría. No caduca con una orden a medias.
+        """
+        if time.monotonic() < self._wake_deadline:
+            return False
+        try:
+            return not json.loads(self.rec.PartialResult()).get("partial", "").strip()
+        except json.JSONDecodeError:
+            return True
+
+    def _check_partial(self):
+        try:
+            partial = json.loads(self.rec.PartialResult()).get("partial", "").strip()
+        except json.JSONDecodeError:
+            return
+        if partial != self._partial:
+            self._partial, self._partial_blocks = partial, 1
+            return
+        self._partial_blocks += 1
+        if partial and self._partial_blocks >= PARTIAL_STABLE_BLOCKS and partial != self._partial_sent:
+            self._partial_sent = partial
+            if DEBUG_LOG: print(f"{self._tag} Parcial: {partial}")
+            self.on_partial(partial)
 
     def _recognize_loop(self):
         """
         Va alimentando a Vosk con bloques y emite texto cuando detecta fin de frase.
         """
         while not self._stop.is_set():
-            data = self.q.get()
-            if self.rec.AcceptWaveform(data):
-                result = self.rec.Result()
-                try:
-                    text = json.loads(result).get("text", "").strip()
-                except json.JSONDecodeError:
-                    text = ""
-                if text:
-                    if DEBUG_LOG: print(f"[STT] Frase: {text}")
-                    self.on_text(text)
+            chunk = self.q.get(self._block_bytes, timeout=0.5)
+            if self.wake_rec is not None and self._awake and self._window_expired():
+                self._sleep()
+            if chunk is None:
+                continue
+            data = self.resampler.process(chunk)
+            if self.gate is None:
+                blocks, ended = [data], False
             else:
-                # Parcial: self.rec.PartialResult() si quieres feedback en vivo
-                pass
+                blocks, ended = self.gate.process(data)
+            for block in blocks:
+                if not self._awake:
+                    self._listen_for_wake_word(block)
+                    continue
+                self._decode(block)
+            if ended:
+                # La puerta se cerró: cerramos la frase sin esperar más silencio
+                if self._awake:
+                    self._emit(self.rec.FinalResult())
+                else:
+                    self._listen_for_wake_word(b"", final=True)
+
+    def _decode(self, block: bytes):
+        if self.open_rec is not None:
+            self._utt_audio.append(block)
+        t0 = time.perf_counter()
+        accepted = self.rec.AcceptWaveform(block)
+        decode_s = time.perf_counter() - t0
+        METRICS.observe("stt_decode_seconds", decode_s, room=self.room)
+        METRICS.observe("stt_rtf", decode_s * SAMPLE_RATE * 2 / max(len(block), 2), RATIO_BUCKETS, room=self.room)
+        if accepted:
+            self._emit(self.rec.Result())
+        elif self.on_partial is not None:
+            self._check_partial()
+
+
+class SttEngine:
+    """
+    Varias habitaciones (un micro cada una) con un único modelo Vosk en memoria.
+    Cada habitación es un VoskSTT con su stream de audio, su KaldiRecognizer y su hilo
+    de reconocimiento (Vosk suelta el GIL al decodificar, así que escalan en núcleos).
+    Los callbacks reciben la habitación como room=<nombre>; con un solo micro, room=None.
+    Con STT_PROCESS, cada habitación reconoce en su propio proceso (SttProcess).
+    """
+    def __init__(self, on_text: Callable[..., None], on_partial: Optional[Callable[..., None]] = None,
+                 rooms: Optional[Dict[str, Union[int, str, None]]] = None,
+                 on_end: Optional[Callable[..., None]] = None):
+        rooms = rooms if rooms is not None else STT_ROOMS
+        if STT_PROCESS:
+            from stt_process import SttProcess as stream_cls
+        else:
+            stream_cls = VoskSTT
+        self.streams: Dict[Optional[str], VoskSTT] = {}
+        for room, device in (rooms or {None: None}).items():
+            self.streams[room] = stream_cls(
+                on_text=partial(on_text, room=room),
+                on_partial=partial(on_partial, room=room) if on_partial else None,
+                device=device,
+                room=room,
+                on_end=partial(on_end, room=room) if on_end else None,
+            )
+            if not STT_PROCESS:
+                self.streams[room].prewarm()  # en modo proceso se precalienta el hijo
+        METRICS.add_collector(self._collect_metrics)
+
+    def _collect_metrics(self, metrics):
+        for room, stt in self.streams.items():
+            metrics.set("audio_queue_bytes", stt.q.depth, room=room)
+            metrics.set("audio_queue_max_bytes", stt.q.max_depth, room=room)
+            metrics.set("audio_queue_overruns", stt.q.overruns, room=room)
+            metrics.set("audio_dropped_bytes", stt.q.dropped_bytes, room=room)
+
+    def start(self):
+        for stt in self.streams.values():
+            stt.start()
+
+    def stop(self):
+        for stt in self.streams.values():
+            stt.stop()
+
+    def add_slot_values(self, values: Iterable[str]):
+        values = list(values)
+        for stt in self.streams.values():
+            stt.add_slot_values(values)
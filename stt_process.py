@@ -0,0 +1,204 @@
+"""
+Reconocimiento en un proceso aparte (config.STT_PROCESS).
+
+El proceso principal solo captura: el callback de sounddevice copia cada bloque a un
+SharedAudioRing (memoria compartida, sin locks). Un proceso hijo por habitación abre
+el mismo ring, corre VoskSTT._recognize_loop con su propio GIL y devuelve textos,
+parciales y cada STT_METRICS_SYNC_S sus métricas (decodificado, RTF, activaciones)
+por un Pipe. Si el hijo muere, SttProcess lo relanza con espera exponencial;
+la captura no se detiene mientras tanto.
+"""
+import multiprocessing as mp
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Optional, Union
+
+from config import (
+    SAMPLE_RATE, CAPTURE_SAMPLE_RATE, AUDIO_BLOCK_MS, AUDIO_BUFFER_MS, DEBUG_LOG,
+    STT_COMMAND_MODE, SLOT_VOCAB_SIZE, STT_RESTART_MIN_S, STT_RESTART_MAX_S, STT_RESTART_RESET_S,
+    STT_METRICS_SYNC_S,
+)
+from audio import SharedAudioRing
+from metrics import METRICS
+
+
+def _worker(ring: SharedAudioRing, conn, room: Optional[str], capture_rate: int, slot_values: List[str]):
+    """
+    Proceso hijo: reconoce el audio del ring y devuelve ("text"|"partial", texto), ("end", "") y
+    ("metrics", METRICS.state()) por `conn`.
+    """
+    from stt import VoskSTT
+    send_lock = threading.Lock()  # envían el hilo de reconocimiento y el de métricas
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    stt = VoskSTT(on_text=lambda text: send(("text", text)),
+                  on_partial=lambda text: send(("partial", text)), room=room,
+                  on_end=lambda: send(("end", "")))
+    stt.set_capture_rate(capture_rate, buffer=ring)
+    stt.add_slot_values(slot_values)
+    stt.prewarm()
+    send(("ready", ""))
+    threading.Thread(target=_control_loop, args=(conn, stt), daemon=True).start()
+    threading.Thread(target=_metrics_loop, args=(send, stt), daemon=True).start()
+    stt._recognize_loop()
+
+
+def _metrics_loop(send, stt):
+    """Las métricas del hijo viven en su propio METRICS: se mandan enteras al padre."""
+    while not stt._stop.wait(STT_METRICS_SYNC_S):
+        try:
+            send(("metrics", METRICS.state()))
+        except (OSError, ValueError):
+            return
+
+
+def _control_loop(conn, stt):
+    """Órdenes del proceso principal; si este desaparece (EOF), el hijo termina."""
+    while True:
+        try:
+            kind, payload = conn.recv()
+        except (EOFError, OSError):
+            kind, payload = "stop", None
+        if kind == "stop":
+            stt._stop.set()
+            return
+        if kind == "slots":
+            stt.add_slot_values(payload)
+
+
+class SttProcess:
+    """
+    Misma interfaz que VoskSTT (start, stop, add_slot_values, q, on_end) con el reconocedor
+    en un proceso hijo supervisado. El hijo se lanza ya en __init__ para que el modelo
+    cargue mientras arranca el resto; los callbacks se llaman desde un hilo del padre.
+    """
+    def __init__(self, on_text: Callable[[str], None], on_partial: Optional[Callable[[str], None]] = None,
+                 device: Union[int, str, None] = None, room: Optional[str] = None,
+                 on_end: Optional[Callable[[], None]] = None):
+        import sounddevice as sd
+        self.on_text = on_text
+        self.on_partial = on_partial
+        self.on_end = on_end
+        self.device = device
+        self.room = room
+        self._tag = f"[STT:{room}]" if room else "[STT]"
+        self.capture_rate = int(CAPTURE_SAMPLE_RATE or sd.query_devices(device, kind="input")["default_samplerate"])
+        self.q = SharedAudioRing(int(self.capture_rate * (AUDIO_BUFFER_MS / 1000)) * 2)
+        self.restarts = 0
+
+        self._ctx = mp.get_context("spawn")  # el hijo no hereda hilos de PortAudio ni el event loop
+        self._proc = None
+        self._conn = None
+        self._send_lock = threading.Lock()
+        self._slot_values: "OrderedDict[str, None]" = OrderedDict()
+        self._stream = None
+        self._stopping = threading.Event()
+        self._supervisor = threading.Thread(target=self._supervise, daemon=True)
+        self._spawn()
+
+    def _spawn(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        self._proc = self._ctx.Process(
+            target=_worker,
+            args=(self.q, child_conn, self.room, self.capture_rate, list(self._slot_values)),
+            name=f"stt-{self.room or 'main'}",
+            daemon=True,
+        )
+        self._proc.start()
+        child_conn.close()  # así recv() da EOF en cuanto el hijo muere
+        self._conn = parent_conn
+
+    def _send(self, message):
+        with self._send_lock:
+            try:
+                self._conn.send(message)
+            except (OSError, ValueError):
+                pass  # hijo caído: el supervisor lo relanza con el estado actual
+
+    def _pump(self):
+        """Reparte lo que llega del hijo hasta que su extremo del pipe se cierra."""
+        while True:
+            try:
+                kind, payload = self._conn.recv()
+            except (EOFError, OSError):
+                return
+            if kind == "text":
+                self.on_text(payload)
+            elif kind == "partial" and self.on_partial is not None:
+                self.on_partial(payload)
+            elif kind == "end" and self.on_end is not None:
+                self.on_end()
+            elif kind == "metrics":
+                # Se suman a las del padre al exportar (un hijo relanzado empieza de cero)
+                METRICS.set_remote(self._proc.name, payload)
+            elif kind == "ready":
+                if DEBUG_LOG: print(f"{self._tag} Reconocedor listo (pid {self._proc.pid})")
+
+    def _supervise(self):
+        delay = STT_RESTART_MIN_S
+        while not self._stopping.is_set():
+            started = time.monotonic()
+            self._pump()
+            if self._stopping.is_set():
+                return
+            self._proc.join(timeout=1)
+            self._conn.close()
+            self.restarts += 1
+            METRICS.inc("stt_restarts_total", room=self.room)
+            if time.monotonic() - started > STT_RESTART_RESET_S:
+                delay = STT_RESTART_MIN_S
+            print(f"{self._tag} El reconocedor terminó (exitcode={self._proc.exitcode}); "
+                  f"reinicio en {delay:.0f}s")
+            if self._stopping.wait(delay):
+                return
+            delay = min(delay * 2, STT_RESTART_MAX_S)
+            self.q.clear()  # lo capturado sin lector ya es viejo
+            self._spawn()
+
+    def add_slot_values(self, values: Iterable[str]):
+        if not STT_COMMAND_MODE:
+            return
+        values = [v.strip().lower() for v in values if v.strip()]
+        # Copia local acotada, para pasársela a un hijo relanzado
+        for v in values:
+            self._slot_values[v] = None
+            self._slot_values.move_to_end(v)
+        while len(self._slot_values) > SLOT_VOCAB_SIZE:
+            self._slot_values.popitem(last=False)
+        self._send(("slots", values))
+
+    def start(self):
+        import sounddevice as sd
+        if DEBUG_LOG: print(f"{self._tag} Iniciando captura de audio ({self.capture_rate} Hz → {SAMPLE_RATE} Hz, "
+                            f"reconocimiento en proceso aparte)…")
+        self._supervisor.start()
+        self._stream = sd.InputStream(
+            device=self.device,
+            samplerate=self.capture_rate,
+            channels=1,
+            dtype="int16",
+            blocksize=int(self.capture_rate * (AUDIO_BLOCK_MS / 1000)),
+            callback=self._audio_callback,
+        )
+        self._stream.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        self._send(("stop", None))
+        self._proc.join(timeout=2)
+        if self._proc.is_alive():
+            self._proc.terminate()
+        self._conn.close()
+        self.q.close()
+
+    def _audio_callback(self, indata, frames, time, status):
+        if status:
+            print(f"[Audio] Estado: {status}")
+        self.q.put(indata)
@@ -0,0 +1,76 @@
+import asyncio
+import socket
+import threading
+
+import mqtt_bus
+
+
+def _read_packet(conn):
+    header = conn.recv(1)
+    if not header:
+        return None, b""
+    length, shift = 0, 0
+    while True:
+        byte = conn.recv(1)[0]
+        length |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    body = b""
+    while len(body) < length:
+        chunk = conn.recv(length - len(body))
+        if not chunk:
+            return None, b""
+        body += chunk
+    return header[0], body
+
+
+class StubBroker:
+    """Broker MQTT v5 mínimo: acepta una conexión, responde CONNACK y PUBACK y guarda los PUBLISH."""
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+        self.published = []
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        conn, _ = self.sock.accept()
+        with conn:
+            while True:
+                kind, body = _read_packet(conn)
+                if kind is None:
+                    return
+                if kind >> 4 == 1:  # CONNECT
+                    conn.sendall(b"\x20\x03\x00\x00\x00")
+                elif kind >> 4 == 3:  # PUBLISH
+                    qos = (kind >> 1) & 3
+                    topic_len = int.from_bytes(body[:2], "big")
+                    self.published.append((body[2:2 + topic_len].decode(), qos))
+                    if qos == 1:
+                        mid = body[2 + topic_len:4 + topic_len]
+                        conn.sendall(b"\x40\x02" + mid)
+                elif kind >> 4 == 12:  # PINGREQ
+                    conn.sendall(b"\xd0\x00")
+                elif kind >> 4 == 14:  # DISCONNECT
+                    return
+
+
+def test_consecutive_qos0_publishes_do_not_block(monkeypatch):
+    broker = StubBroker()
+    monkeypatch.setattr(mqtt_bus, "MQTT_HOST", "127.0.0.1")
+    monkeypatch.setattr(mqtt_bus, "MQTT_PORT", broker.port)
+    monkeypatch.setattr(mqtt_bus, "MQTT_OUTBOX_PATH", None)
+
+    async def run():
+        bus = mqtt_bus.MqttBus()
+        await asyncio.wait_for(bus.connect(), 5)
+        for i in range(5):
+            await bus.publish("tts/say", f"chiste {i}")
+        await bus.publish("spotify/next", "1", qos=1)
+        await asyncio.wait_for(bus._outq.join(), 5)
+        await bus.disconnect()
+
+    asyncio.run(asyncio.wait_for(run(), 10))
+    assert [topic for topic, _ in broker.published] == ["assistant/tts/say"] * 5 + ["assistant/spotify/next"]
@@ -0,0 +1,284 @@
+import os
+import json
+import queue
+import hashlib
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import wave
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import paho.mqtt.client as mqtt
+
+from actions import _JOKES
+from metrics import METRICS, serve_http
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# ---------- Config ----------
+MQTT_HOST = os.getenv("MQTT_HOST", "localhost")
+MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
+BASE = os.getenv("MQTT_BASE_TOPIC", "assistant")
+
+TTS_ENGINE = os.getenv("TTS_ENGINE", "auto")  # "piper", "espeak" o "auto" (piper si hay modelo)
+TTS_PIPER_MODEL = os.getenv("TTS_PIPER_MODEL")  # p.ej. models/es_ES-davefx-medium.onnx (+ .onnx.json)
+TTS_VOICE = os.getenv("TTS_VOICE", "es")  # voz de espeak-ng
+TTS_OUTPUT_DEVICE = os.getenv("TTS_OUTPUT_DEVICE") or None  # dispositivo de salida de sounddevice
+TTS_CACHE_DIR = Path(os.getenv("TTS_CACHE_DIR", ".cache-tts"))
+TTS_CACHE_MAX_MB = float(os.getenv("TTS_CACHE_MAX_MB", "100"))  # al pasarse se borra lo menos usado
+TTS_CHUNK_BYTES = 4096  # PCM que se reproduce en cuanto llega (~90 ms a 22 kHz)
+METRICS_PORT = int(os.getenv("TTS_METRICS_PORT", "0")) or None  # endpoint Prometheus /metrics
+
+TOPIC_SAY = f"{BASE}/tts/say"  # payload: texto a decir
+
+# Frases fijas que se sintetizan al arrancar para que suenen sin esperar al motor
+CONFIRMATIONS = ["Vale.", "Hecho.", "Ahora mismo.", "No te he entendido.", "No encontré esa canción."]
+PRERENDER = list(_JOKES) + CONFIRMATIONS
+
+
+class TtsEngine:
+    """
+    Motor TTS offline como proceso externo que escribe PCM int16 mono por stdout
+    mientras sintetiza (así se puede reproducir antes de que termine).
+    - piper: --output-raw, frecuencia en el .onnx.json del modelo.
+    - espeak-ng: --stdout da un WAV; la frecuencia sale de su cabecera.
+    """
+    def __init__(self, kind: str):
+        self.kind = kind
+        if kind == "piper":
+            config = json.loads(Path(f"{TTS_PIPER_MODEL}.json").read_text(encoding="utf-8"))
+            self.rate = int(config["audio"]["sample_rate"])
+            self.id = f"piper:{Path(TTS_PIPER_MODEL).name}"
+        else:
+            self.rate = None  # se lee de la cabecera WAV
+            self.id = f"espeak:{TTS_VOICE}"
+
+    def stream(self, text: str) -> Tuple[int, Iterator[bytes]]:
+        """(frecuencia, iterador de trozos PCM) según los va produciendo el motor."""
+        if self.kind == "piper":
+            argv = ["piper", "--model", TTS_PIPER_MODEL, "--output-raw"]
+        else:
+            argv = ["espeak-ng", "-v", TTS_VOICE, "--stdout"]
+        proc = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        proc.stdin.write(text.encode("utf-8"))
+        proc.stdin.close()
+        rate = self.rate
+        if rate is None:
+            header = proc.stdout.read(44)
+            rate = int.from_bytes(header[24:28], "little") if len(header) == 44 else 22050
+        return rate, self._chunks(proc)
+
+    @staticmethod
+    def _chunks(proc: subprocess.Popen) -> Iterator[bytes]:
+        """Lanza RuntimeError al final si el motor falló: ese audio no debe ir a la caché."""
+        try:
+            while True:
+                chunk = proc.stdout.read1(TTS_CHUNK_BYTES)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            proc.stdout.close()
+            proc.wait()
+        if proc.returncode != 0:
+            raise RuntimeError(f"el motor terminó con código {proc.returncode}")
+
+
+def make_engine() -> TtsEngine:
+    kind = TTS_ENGINE
+    if kind == "auto":
+        kind = "piper" if TTS_PIPER_MODEL and shutil.which("piper") else "espeak"
+    return TtsEngine(kind)
+
+
+class TtsCache:
+    """
+    Audio ya sintetizado en disco (WAV), con nombre = hash del motor/voz y del texto.
+    Acotado a max_bytes: al pasarse se borra lo que lleva más tiempo sin sonar
+    (la fecha de modificación se actualiza en cada acierto).
+    """
+    def __init__(self, directory: Path = TTS_CACHE_DIR, max_bytes: int = int(TTS_CACHE_MAX_MB * 1024 * 1024)):
+        self.dir = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, engine_id: str, text: str) -> Path:
+        key = hashlib.sha256(f"{engine_id}\n{' '.join(text.split())}".encode("utf-8")).hexdigest()
+        return self.dir / f"{key}.wav"
+
+    def lookup(self, engine_id: str, text: str) -> Optional[Path]:
+        path = self.path(engine_id, text)
+        if path.exists():
+            self.hits += 1
+            os.utime(path)
+            return path
+        self.misses += 1
+        return None
+
+    def store(self, engine_id: str, text: str, rate: int, pcm: bytes):
+        path = self.path(engine_id, text)
+        # Temporal único: el pre-render y la reproducción pueden guardar la misma frase a la vez
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f, wave.open(f, "wb") as wf:
+                wf.setnchannels(1)
+                wf.setsampwidth(2)
+                wf.setframerate(rate)
+                wf.writeframes(pcm)
+            os.replace(tmp, path)  # atómico: nunca queda un WAV a medias con el nombre bueno
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            files = [(p.stat().st_mtime, p.stat().st_size, p) for p in self.dir.glob("*.wav")]
+            total = sum(size for _, size, _ in files)
+            for _, size, p in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                p.unlink(missing_ok=True)
+                total -= size
+
+
+def read_wav_chunks(path: Path) -> Tuple[int, Iterator[bytes]]:
+    wf = wave.open(str(path), "rb")
+
+    def chunks():
+        with wf:
+            while True:
+                data = wf.readframes(TTS_CHUNK_BYTES // 2)
+                if not data:
+                    break
+                yield data
+    return wf.getframerate(), chunks()
+
+
+class TtsAgent:
+    def __init__(self):
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5)
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.client.on_disconnect = self._on_disconnect
+
+        self.engine = make_engine()
+        self.cache = TtsCache()
+        self._queue: "queue.Queue[Tuple[str, Optional[str], float]]" = queue.Queue()
+
+    # ---- MQTT callbacks ----
+    def _on_connect(self, client, userdata, *args):
+        reason_code = args[1] if len(args) >= 2 else 0
+        code = getattr(reason_code, "value", reason_code)
+        print(f"[MQTT] Conectado (code={code})")
+        client.subscribe(TOPIC_SAY)
+
+    def _on_disconnect(self, client, userdata, *args):
+        code = getattr(args[-2], "value", args[-2]) if len(args) >= 2 else 0
+        print(f"[MQTT] Desconectado (code={code})")
+
+    def _on_message(self, client, userdata, msg):
+        # Solo encola: la síntesis y la reproducción van en su propio hilo
+        text = msg.payload.decode("utf-8").strip()
+        props = dict(getattr(getattr(msg, "properties", None), "UserProperty", None) or [])
+        if text:
+            self._queue.put((text, props.get("trace"), time.perf_counter()))
+
+    # ---- Síntesis ----
+    def render(self, text: str) -> Tuple[int, Iterator[bytes], bool]:
+        """
+        (frecuencia, trozos PCM, acierto de caché). En un fallo los trozos salen del
+        motor según se sintetizan y, al terminar, el audio completo se guarda en caché.
+        """
+        cached = self.cache.lookup(self.engine.id, text)
+        if cached is not None:
+            rate, chunks = read_wav_chunks(cached)
+            return rate, chunks, True
+        rate, chunks = self.engine.stream(text)
+
+        def tee():
+            pcm: List[bytes] = []
+            for chunk in chunks:
+                pcm.append(chunk)
+                yield chunk
+            # Solo llega aquí si el motor acabó bien; sin audio tampoco se guarda
+            if pcm:
+                self.cache.store(self.engine.id, text, rate, b"".join(pcm))
+        return rate, tee(), False
+
+    def prerender(self, texts: List[str]):
+        """Sintetiza a caché (sin reproducir) las frases fijas que aún no estén."""
+        done = failed = 0
+        for text in texts:
+            if self.cache.path(self.engine.id, text).exists():
+                continue
+            try:
+                rate, chunks = self.engine.stream(text)
+                pcm = b"".join(chunks)
+            except Exception as e:
+                failed += 1
+                print(f"[TTS] No se pudo pre-renderizar «{text}»: {e}")
+                continue
+            if not pcm:
+                failed += 1
+                print(f"[TTS] El motor no devolvió audio para «{text}»")
+                continue
+            self.cache.store(self.engine.id, text, rate, pcm)
+            done += 1
+        print(f"[TTS] Pre-renderizadas {done} frases ({len(texts) - done - failed} ya en caché, {failed} fallidas)")
+
+    # ---- Reproducción ----
+    def _play(self, text: str, trace: Optional[str], received: float):
+        import sounddevice as sd
+        rate, chunks, hit = self.render(text)
+        first = True
+        pending = b""
+        with sd.RawOutputStream(samplerate=rate, channels=1, dtype="int16", device=TTS_OUTPUT_DEVICE) as out:
+            for chunk in chunks:
+                data = pending + chunk
+                cut = len(data) - len(data) % 2  # muestras completas
+                data, pending = data[:cut], data[cut:]
+                if not data:
+                    continue
+                if first:
+                    first = False
+                    latency = time.perf_counter() - received
+                    METRICS.observe("tts_first_audio_seconds", latency, cache="hit" if hit else "miss")
+                    print(f"[TTS] Diciendo ({'caché' if hit else 'motor'}, {latency * 1000:.0f} ms): {text}"
+                          + (f" [{trace}]" if trace else ""))
+                out.write(data)
+
+    def play_loop(self):
+        while True:
+            text, trace, received = self._queue.get()
+            try:
+                self._play(text, trace, received)
+            except Exception as e:
+                print(f"[TTS] Error reproduciendo: {e}")
+
+    # ---- Ciclo ----
+    def start(self):
+        print(f"[TTS] Motor: {self.engine.id} | caché: {self.cache.dir} ({TTS_CACHE_MAX_MB:.0f} MB)")
+        METRICS.add_collector(lambda m: (m.set("tts_cache_hits", self.cache.hits),
+                                         m.set("tts_cache_misses", self.cache.misses)))
+        if METRICS_PORT:
+            serve_http(METRICS, METRICS_PORT)
+        threading.Thread(target=self.prerender, args=(PRERENDER,), daemon=True).start()
+        threading.Thread(target=self.play_loop, daemon=True).start()
+        self.client.connect(MQTT_HOST, MQTT_PORT, 60)
+        try:
+            self.client.loop_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.client.disconnect()
+
+if __name__ == "__main__":
+    TtsAgent().start()